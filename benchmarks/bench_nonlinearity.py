@@ -0,0 +1,74 @@
+#Compares the time and peak memory of the in-place Horner nonlinearity
+#correction in calibrate.py with the power-series version it replaced, on
+#synthetic cubes of realistic MIRI and NIRCam segment sizes.
+#Each measurement runs in a fresh process so peak RSS is meaningful.
+#Usage: python benchmarks/bench_nonlinearity.py
+import sys
+import os
+import time
+import resource
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+#N_int, N_grp, N_row, N_col
+SIZES = {"MIRI": (40, 50, 416, 72),
+         "NIRCAM": (40, 20, 64, 2048)}
+N_COEFFS = 5
+
+def get_inputs(shape):
+    rng = np.random.default_rng(0)
+    data = rng.uniform(0, 4e4, shape)
+    coeffs = np.zeros((N_COEFFS,) + shape[2:])
+    coeffs[1] = 1
+    for i in range(2, N_COEFFS):
+        coeffs[i] = rng.normal(0, 1e-5 ** i, shape[2:])
+    return data, (coeffs, np.zeros(shape[2:], dtype=bool))
+
+
+def apply_nonlinearity_power_series(data, nonlinearity):
+    #The original implementation, for comparison
+    coeffs, mask = nonlinearity
+    result = np.zeros(data.shape, dtype=np.float64)
+    exp_data = np.ones(data.shape, dtype=np.float64)
+    for i in range(len(coeffs)):
+        result += coeffs[i] * exp_data
+        exp_data *= data
+    return result, mask
+
+
+def run_one(method, instrument):
+    data, nonlinearity = get_inputs(SIZES[instrument])
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if method == "old":
+        result, _ = apply_nonlinearity_power_series(data, nonlinearity)
+    else:
+        from calibrate import apply_nonlinearity
+        result, _ = apply_nonlinearity(data, nonlinearity)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    np.save(os.devnull, result[:, -1, 0])
+    #ru_maxrss is in kB on Linux
+    print(elapsed, (after - before) / 1e6)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        run_one(sys.argv[1], sys.argv[2])
+        sys.exit()
+
+    data, nonlinearity = get_inputs((2, 5, 16, 16))
+    expected, _ = apply_nonlinearity_power_series(data, nonlinearity)
+    from calibrate import apply_nonlinearity
+    result, _ = apply_nonlinearity(np.copy(data), nonlinearity)
+    print("Max relative difference", np.max(np.abs(result / expected - 1)))
+
+    print("{:8s} {:>12s} {:>10s} {:>18s}".format("", "Cube (GB)", "Time (s)", "Extra peak RSS (GB)"))
+    for instrument, shape in SIZES.items():
+        for method in ["old", "new"]:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), method, instrument],
+                                    capture_output=True, text=True, check=True).stdout
+            elapsed, peak = [float(x) for x in output.split("\n")[-2].split()]
+            print("{:8s} {:>12.2f} {:>10.2f} {:>18.2f}  {}".format(instrument, np.prod(shape) * 8 / 1e9, elapsed, peak, method))
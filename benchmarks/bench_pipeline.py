@@ -0,0 +1,121 @@
+#Runs every step of the README on synthetic data from make_synthetic.py and
+#records the time, throughput and peak memory of each, so that regressions
+#are visible.  Each step runs in its own process, with HOME pointing at the
+#synthetic reference files.  Results are printed and appended, with the git
+#revision, to the results file (pipeline_results.txt in work_dir by default,
+#so that nothing is written to the source tree).  The synthetic data is
+#written with the instrument selected in constants.py; its logs are kept in
+#work_dir.
+#Usage: python benchmarks/bench_pipeline.py [work_dir] [--segments 2] [--ints 100] [--groups 10] [--skip-fit]
+import sys
+import os
+import glob
+import time
+import argparse
+import subprocess
+import tempfile
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def script(name):
+    return os.path.join(PACKAGE_DIR, name)
+
+
+def get_steps(args, wavelength_range):
+    #(name, command, number of integrations processed, directory to run in
+    #or None for work_dir); commands are functions, so that globs are
+    #expanded when the step runs.  Every glob is sorted, so that each step
+    #sees the segments in the same order (the positions are paired with the
+    #spectra by order).
+    num_ints = args.segments * args.ints
+    steps = [("calibrate", lambda: [script("calibrate.py")] + sorted(glob.glob("*_uncal.fits")), num_ints, None),
+             ("median_residuals", lambda: [script("get_med_residuals.py")] + sorted(glob.glob("rateints_*.fits")), num_ints, None),
+             ("recalibrate", lambda: [script("calibrate.py")] + sorted(glob.glob("*_uncal.fits")) + ["--median-residuals", "median_residuals.npy"], num_ints, None),
+             ("remove_bkd", lambda: [script("remove_bkd.py")] + sorted(glob.glob("rateints_*.fits")), num_ints, None),
+             ("positions", lambda: [script("get_positions_and_median_image.py")] + sorted(glob.glob("cleaned_rateints_*.fits")), num_ints, None),
+             ("optimal_extract", lambda: [script("optimal_extract.py")] + sorted(glob.glob("cleaned_rateints_*.fits")), num_ints, None),
+             ("simple_extract", lambda: [script("simple_extract.py")] + sorted(glob.glob("cleaned_rateints_*.fits")), num_ints, None),
+             ("gather", lambda: [script("gather_and_filter.py")] + sorted(glob.glob("optx1d_*.fits")), num_ints, None),
+             #Steps 4 to 10 in one process, for comparison with their sum.
+             #It writes the same optx1d, x1d and data.pkl files, so it runs
+             #in its own directory to leave those of the separate steps for
+             #the fit.
+             ("run_pipeline", lambda: [script("run_pipeline.py")] + sorted(os.path.abspath(f) for f in glob.glob("*_uncal.fits")), num_ints, "run_pipeline")]
+    if not args.skip_fit:
+        steps.append(("fit", lambda: [script("extract_eclipse.py"), "synthetic.cfg", str(wavelength_range[0]), str(wavelength_range[1]),
+                                      "-e", "0", "--burn-in-runs", "20", "--production-runs", "20", "--num-walkers", "20"], num_ints, None))
+    return steps
+
+
+def run_step(name, command, directory=None):
+    #Returns the wall time and the peak RSS of the step's process in GB, or
+    #None if it failed.  The log is written to the current directory, and
+    #the step runs in directory if given.
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    with open("{}.log".format(name), "w") as log:
+        start = time.time()
+        process = subprocess.Popen([sys.executable] + command, stdout=log, stderr=subprocess.STDOUT, cwd=directory)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        print("{} failed, see {}.log".format(name, name))
+        return elapsed, None
+    #ru_maxrss is in kB on Linux
+    return elapsed, usage.ru_maxrss / 1e6
+
+
+def get_revision():
+    result = subprocess.run(["git", "-C", PACKAGE_DIR, "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("work_dir", nargs="?", default=None, help="Defaults to a temporary directory")
+    parser.add_argument("--segments", type=int, default=2)
+    parser.add_argument("--ints", type=int, default=100, help="Integrations per segment; at least 100 in total for gather_and_filter.py")
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--skip-fit", action="store_true", help="Skip the emcee fit, which needs batman")
+    parser.add_argument("-o", "--output", help="Results file to append to.  Defaults to pipeline_results.txt in work_dir")
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="sparta_bench_"))
+    os.makedirs(work_dir, exist_ok=True)
+    output = os.path.abspath(args.output or os.path.join(work_dir, "pipeline_results.txt"))
+    #constants.py finds the reference files through HOME, here too
+    os.environ.update(HOME=os.path.join(work_dir, "home"), MPLBACKEND="Agg")
+
+    subprocess.run([sys.executable, os.path.join(PACKAGE_DIR, "benchmarks", "make_synthetic.py"), work_dir,
+                    "--segments", str(args.segments), "--ints", str(args.ints), "--groups", str(args.groups)],
+                   check=True, stdout=subprocess.DEVNULL)
+
+    #Fit the whole band that gets extracted
+    sys.path.insert(0, PACKAGE_DIR)
+    from constants import INSTRUMENT, FILTER, X_MIN, X_MAX
+    from wave_sol import get_wavelengths
+    wavelengths = get_wavelengths(INSTRUMENT, FILTER)[X_MIN:X_MAX] * 1000
+    wavelength_range = (min(wavelengths), max(wavelengths) + 1)
+
+    os.chdir(work_dir)
+    revision = get_revision()
+    date = time.strftime("%Y-%m-%dT%H:%M:%S")
+    results = []
+    print("{:18s} {:>10s} {:>12s} {:>14s}".format("Step", "Time (s)", "Ints/s", "Peak RSS (GB)"))
+    for name, command, num_ints, directory in get_steps(args, wavelength_range):
+        elapsed, peak = run_step(name, command(), directory)
+        if peak is None:
+            results.append((name, elapsed, float("nan"), float("nan")))
+            continue
+        results.append((name, elapsed, num_ints / elapsed, peak))
+        print("{:18s} {:>10.2f} {:>12.1f} {:>14.2f}".format(*results[-1]))
+
+    new_file = not os.path.exists(output)
+    with open(output, "a") as f:
+        if new_file:
+            f.write("#date revision instrument segments ints groups step time_s ints_per_s peak_rss_gb\n")
+        for result in results:
+            f.write("{} {} {} {} {} {} {} {:.3f} {:.3f} {:.3f}\n".format(
+                date, revision, INSTRUMENT, args.segments, args.ints, args.groups, *result))
+    print("Results appended to", output)
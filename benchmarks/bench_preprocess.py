@@ -0,0 +1,86 @@
+#Compares the fused calibrate_ramps in calibrate.py, which applies every
+#correction to one cache-sized block at a time, with applying the
+#corrections one after the other over the whole cube, as it used to.  All
+#corrections, including the ref pixels, are enabled.  The results should be
+#identical.  Each measurement runs in a fresh process so peak RSS is
+#meaningful.
+#Usage: python benchmarks/bench_preprocess.py
+import sys
+import os
+import time
+import resource
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import calibrate
+calibrate.SKIP_SUPERBIAS = False
+calibrate.SKIP_REF = False
+calibrate.N_REF = 4
+calibrate.INSTRUMENT = "NIRSPEC"
+
+#N_int, N_grp, N_row, N_col
+SIZES = {"NIRSPEC": (100, 20, 32, 512),
+         "NIRCAM": (40, 20, 64, 2048)}
+N_OUTPUTS = 4
+N_COEFFS = 5
+
+def get_inputs(shape):
+    rng = np.random.default_rng(0)
+    frame_shape = shape[2:]
+    data = rng.uniform(1e4, 4e4, shape).astype(np.uint16).astype(np.float64)
+    superbias = rng.normal(1e4, 100, frame_shape)
+    coeffs = np.zeros((N_COEFFS,) + frame_shape)
+    coeffs[1] = 1
+    for i in range(2, N_COEFFS):
+        coeffs[i] = rng.normal(0, 1e-5 ** i, frame_shape)
+    dark = np.cumsum(rng.uniform(0, 0.1, (shape[1],) + frame_shape), axis=0)
+    gain = rng.uniform(1, 2, frame_shape)
+    mask = np.zeros(frame_shape, dtype=bool)
+    return data, superbias, (coeffs, mask), (dark, mask), gain
+
+
+def calibrate_ramps_unfused(data, noutputs, nframes, groupgap, superbias, nonlinearity, dark, gain):
+    #One pass over the cube per correction, for comparison
+    data = calibrate.subtract_superbias(data, superbias)
+    data = calibrate.subtract_ref(data, noutputs)
+    data, _ = calibrate.apply_nonlinearity(data, nonlinearity)
+    data = calibrate.destripe(data)
+    data, _ = calibrate.subtract_dark(data, nframes, groupgap, dark)
+    return data * gain
+
+
+def run(method, data, superbias, nonlinearity, dark, gain):
+    func = calibrate.calibrate_ramps if method == "fused" else calibrate_ramps_unfused
+    return func(data, N_OUTPUTS, 1, 0, superbias, nonlinearity, dark, gain)
+
+
+def run_one(method, instrument):
+    inputs = get_inputs(SIZES[instrument])
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = run(method, *inputs)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    np.save(os.devnull, result[:, -1, 0])
+    #ru_maxrss is in kB on Linux
+    print(elapsed, (after - before) / 1e6)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        run_one(sys.argv[1], sys.argv[2])
+        sys.exit()
+
+    data, superbias, nonlinearity, dark, gain = get_inputs((3, 6, 32, 64))
+    expected = run("unfused", np.copy(data), superbias, nonlinearity, dark, gain)
+    result = run("fused", np.copy(data), superbias, nonlinearity, dark, gain)
+    print("Identical results:", np.array_equal(result, expected))
+
+    print("{:8s} {:>12s} {:>10s} {:>18s}".format("", "Cube (GB)", "Time (s)", "Extra peak RSS (GB)"))
+    for instrument, shape in SIZES.items():
+        for method in ["unfused", "fused"]:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), method, instrument],
+                                    capture_output=True, text=True, check=True).stdout
+            elapsed, peak = [float(x) for x in output.split("\n")[-2].split()]
+            print("{:8s} {:>12.2f} {:>10.2f} {:>18.2f}  {}".format(instrument, np.prod(shape) * 8 / 1e9, elapsed, peak, method))
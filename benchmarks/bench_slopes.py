@@ -0,0 +1,42 @@
+#Times get_slopes on a synthetic MIRI-like segment with cosmic rays.
+#get_slopes prints the number of active pixels in each iteration.
+#Usage: python benchmarks/bench_slopes.py [N_int] [N_grp]
+import sys
+import os
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from calibrate import get_slopes
+
+N_int = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+N_grp = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+N_row, N_col = 416, 72
+#Fraction of pixels hit by a cosmic ray in each integration
+CR_RATE = 0.02
+
+def get_ramps(rng):
+    flux = rng.uniform(0, 300, (N_row, N_col))
+    read_noise = rng.uniform(8, 12, (N_row, N_col))
+    ramps = np.empty((N_int, N_grp, N_row, N_col))
+    for i in range(N_int):
+        ramps[i] = np.cumsum(rng.poisson(flux, (N_grp, N_row, N_col)), axis=0) \
+            + rng.normal(0, read_noise, (N_grp, N_row, N_col))
+
+    num_hits = int(CR_RATE * N_int * N_row * N_col)
+    ints = rng.integers(0, N_int, num_hits)
+    hit_grps = rng.integers(1, N_grp, num_hits)
+    rows = rng.integers(0, N_row, num_hits)
+    cols = rng.integers(0, N_col, num_hits)
+    amplitudes = 10**rng.uniform(1.5, 4, num_hits)
+    for i, g, r, c, a in zip(ints, hit_grps, rows, cols, amplitudes):
+        ramps[i, g:, r, c] += a
+    return ramps, read_noise
+
+
+if __name__ == "__main__":
+    ramps, read_noise = get_ramps(np.random.default_rng(0))
+    start = time.time()
+    signal, error, pixel_mask, _, bad_pixels = get_slopes(ramps, read_noise, residuals=False)
+    print("get_slopes took {:.2f} s for {} integrations of {} groups".format(time.time() - start, N_int, N_grp))
+    print("Flagged pixels: {}, entirely bad: {}".format(np.sum(pixel_mask), len(bad_pixels)))
@@ -0,0 +1,37 @@
+#Compares the tabulated optimal ramp weights used by get_slopes with the
+#exact formula, in speed and accuracy, for one MIRI-sized integration.
+#Usage: python benchmarks/bench_weights.py [N_grp]
+import sys
+import os
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from calibrate import get_optimal_weights, get_weights, get_weight_table
+
+N_grp = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+N = N_grp - 1
+N_row, N_col = 416, 72
+N_repeats = 20
+
+rng = np.random.default_rng(0)
+R = rng.uniform(5, 30, (N_row, N_col))
+ratio = 10**rng.uniform(-6, 4, (N_row, N_col))
+
+start = time.time()
+get_weight_table(N)
+print("Building table took {:.3f} s".format(time.time() - start))
+
+start = time.time()
+for i in range(N_repeats):
+    exact = R[:,:,np.newaxis]**-2 * get_optimal_weights(ratio, N)
+exact_time = (time.time() - start) / N_repeats
+
+start = time.time()
+for i in range(N_repeats):
+    tabulated = get_weights(ratio, R, N)
+tabulated_time = (time.time() - start) / N_repeats
+
+print("Exact: {:.4f} s per integration, tabulated: {:.4f} s per integration ({:.1f}x)".format(
+    exact_time, tabulated_time, exact_time / tabulated_time))
+print("Max relative weight error", np.max(np.abs(tabulated / exact - 1)))
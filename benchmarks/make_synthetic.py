@@ -0,0 +1,240 @@
+#Writes synthetic uncal segments for the INSTRUMENT, SUBARRAY and FILTER
+#selected in constants.py, with fake reference files to match, so that the
+#whole pipeline can be run without MAST data.  The ramps have a trace with
+#per-integration jitter, background, shot and read noise, 1/f noise,
+#amplifier offsets, dark current, non-linearity, cosmic rays, a few
+#saturating pixels, and an eclipse (or transit) of the trace.
+#The reference files are written where constants.py looks for them, so run
+#this and the pipeline with the same HOME.  A config file for
+#extract_eclipse.py (or extract_transit.py) is written to the output
+#directory.
+#Usage: python benchmarks/make_synthetic.py output_dir [--segments 2] [--ints 100] [--groups 10]
+import sys
+import os
+import argparse
+import numpy as np
+import astropy.io.fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from constants import *
+
+#gain (e/DN), read noise (DN), 1/f noise (DN rms), whether the 1/f noise
+#runs down the columns (stripes constant along them) instead of along the
+#rows, number of amplifiers, detector name, trace width (pixels) and peak
+#flux of the trace (e/group/pixel)
+LAYOUTS = {"NIRSPEC": dict(gain=1.0, read_noise=10, one_over_f=5, column_major=True, noutputs=1,
+                           detector="nrs1", trace_sigma=1.2, peak_flux=1500),
+           "MIRI": dict(gain=3.1, read_noise=8, one_over_f=1, column_major=False, noutputs=1,
+                        detector="mirimage", trace_sigma=1.5, peak_flux=2000),
+           "NIRCAM": dict(gain=1.8, read_noise=12, one_over_f=8, column_major=False, noutputs=4,
+                          detector="nrcalong", trace_sigma=2, peak_flux=3000)}
+LAYOUT = LAYOUTS[INSTRUMENT]
+
+BIAS = 12000
+BKD_FLUX = 5
+DARK_CURRENT = 0.02
+NONLINEARITY = 1e-7
+CR_RATE = 2e-4
+SATURATED_PIXELS = 5
+JITTER = 0.02
+#System parameters, in the format of the example config files
+SYSTEM = dict(t0=59849.7792, per=2.218575143, rp=0.1504, a=8.73, inc=85.69, fp=1.8e-3)
+#Span of the observation, centered on the eclipse or transit (days)
+DURATION = 0.25
+
+def get_frame_shape():
+    return BOT - TOP, RIGHT - LEFT
+
+
+def to_raw(image):
+    #Rotated, cropped coordinates to those of the files
+    return np.ascontiguousarray(np.rot90(image, -ROTATE, axes=(-2,-1)))
+
+
+def write_ref(filename, data, dq=None, subarray=False, sci_name=None, extra=None):
+    header = astropy.io.fits.Header()
+    if subarray:
+        header["SUBSTRT1"] = LEFT + 1
+        header["SUBSTRT2"] = TOP + 1
+    hdus = [astropy.io.fits.PrimaryHDU(header=header), astropy.io.fits.ImageHDU(to_raw(data), name=sci_name)]
+    if dq is not None:
+        hdus.append(astropy.io.fits.ImageHDU(to_raw(dq), name="DQ"))
+    hdus += extra or []
+    path = os.path.join(REF_DIR, os.path.basename(filename))
+    astropy.io.fits.HDUList(hdus).writeto(path, overwrite=True)
+    print("Wrote", path)
+
+
+def make_references(rng, num_groups):
+    os.makedirs(REF_DIR, exist_ok=True)
+    shape = get_frame_shape()
+    no_dq = np.zeros(shape, dtype=np.uint32)
+    bad = rng.random(shape) < 1e-3
+
+    refs = {}
+    refs["gain"] = rng.normal(LAYOUT["gain"], 0.02 * LAYOUT["gain"], shape).astype(np.float32)
+    write_ref(GAIN_FILE, refs["gain"], subarray=True)
+    refs["read_noise"] = rng.normal(LAYOUT["read_noise"], 0.5, shape).astype(np.float32)
+    write_ref(RNOISE_FILE, refs["read_noise"], subarray=True)
+
+    coeffs = np.zeros((4,) + shape, dtype=np.float32)
+    coeffs[1] = 1
+    coeffs[2] = NONLINEARITY
+    write_ref(NONLINEAR_FILE, coeffs, dq=bad.astype(np.uint32), subarray=True)
+
+    refs["superbias"] = rng.normal(BIAS, 300, shape)
+    if SUPERBIAS_FILE is not None:
+        write_ref(SUPERBIAS_FILE, refs["superbias"].astype(np.float32))
+
+    refs["dark"] = np.cumsum(rng.normal(DARK_CURRENT, 0.005, (num_groups + 5,) + shape), axis=0)
+    write_ref(DARK_FILE, refs["dark"].astype(np.float32), dq=no_dq)
+
+    #The mask covers the full frame, and is cropped by calibrate.py
+    mask = np.zeros((BOT, RIGHT), dtype=np.uint32)
+    mask[TOP:BOT, LEFT:RIGHT][bad] = 1
+    write_ref(MASK_FILE, np.zeros((BOT, RIGHT), dtype=np.float32), dq=mask)
+
+    refs["flat"] = np.ones(shape)
+    if FLAT_FILE is not None:
+        refs["flat"] = rng.normal(1, 0.01, shape)
+        write_ref(FLAT_FILE, refs["flat"].astype(np.float32), sci_name="SCI",
+                  extra=[astropy.io.fits.ImageHDU(to_raw(np.full(shape, 0.01, dtype=np.float32)), name="ERR")])
+
+    if WCS_FILE is not None:
+        #MIRI: wavelength as a function of detector row, as in the specwcs file
+        ys = np.arange(300, 1000)
+        table = astropy.io.fits.BinTableHDU.from_columns([
+            astropy.io.fits.Column(name="Y_CENTER", format="D", array=ys),
+            astropy.io.fits.Column(name="WAVELENGTH", format="D", array=np.linspace(14, 4, len(ys)))])
+        header = astropy.io.fits.Header()
+        header["IMYSLTL"] = 0
+        astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(header=header), table]).writeto(
+            os.path.join(REF_DIR, os.path.basename(WCS_FILE)), overwrite=True)
+    return refs
+
+
+def get_light_curve(times, transit):
+    #Trapezoidal eclipse or transit, without limb darkening
+    per, rp, a, inc = SYSTEM["per"], SYSTEM["rp"], SYSTEM["a"], SYSTEM["inc"]
+    b = a * np.cos(np.deg2rad(inc))
+    t14 = per / np.pi * np.arcsin(np.sqrt((1 + rp)**2 - b**2) / (a * np.sin(np.deg2rad(inc))))
+    t23 = per / np.pi * np.arcsin(np.sqrt(max(0, (1 - rp)**2 - b**2)) / (a * np.sin(np.deg2rad(inc))))
+    center = SYSTEM["t0"] if transit else SYSTEM["t0"] + per / 2
+    depth = rp**2 if transit else SYSTEM["fp"] / (1 + SYSTEM["fp"])
+    dt = np.abs(times - center)
+    fraction = np.clip((t14 / 2 - dt) / ((t14 - t23) / 2), 0, 1)
+    return 1 - depth * fraction
+
+
+def get_trace(shape):
+    #Trace centered on Y_CENTER, curved for NIRCAM, with a smooth spectrum
+    #between X_MIN and X_MAX.  Returns the center and flux of each column.
+    xs = np.arange(shape[1])
+    x_mid = (X_MIN + X_MAX) / 2
+    center = Y_CENTER + (1e-6 * (xs - x_mid)**2 if INSTRUMENT == "NIRCAM" else 0)
+    spectrum = LAYOUT["peak_flux"] * np.exp(-((xs - x_mid) / (X_MAX - X_MIN))**2)
+    spectrum[(xs < X_MIN - 20) | (xs > X_MAX + 20)] *= 0.01
+    return center, spectrum
+
+
+def get_one_over_f(rng, num_frames, shape):
+    #Noise with a 1/f spectrum in readout order, in the coordinates of the files
+    raw_shape = to_raw(np.zeros(shape)).shape
+    if LAYOUT["column_major"] != (ROTATE % 2 != 0):
+        raw_shape = raw_shape[::-1]
+    num_pixels = raw_shape[0] * raw_shape[1]
+    spectrum = np.fft.rfft(rng.normal(0, 1, (num_frames, num_pixels)), axis=1)
+    freqs = np.fft.rfftfreq(num_pixels)
+    spectrum[:, 0] = 0
+    spectrum[:, 1:] /= np.sqrt(freqs[1:] / freqs[1])
+    noise = np.fft.irfft(spectrum, num_pixels, axis=1)
+    noise *= LAYOUT["one_over_f"] / np.std(noise)
+    noise = noise.reshape((num_frames,) + raw_shape)
+    if LAYOUT["column_major"] != (ROTATE % 2 != 0):
+        noise = np.swapaxes(noise, -1, -2)
+    return noise
+
+
+def make_segment(rng, refs, filename, times, int_start, num_groups, transit):
+    num_ints = len(times)
+    shape = get_frame_shape()
+    num_rows, num_cols = shape
+    light_curve = get_light_curve(times, transit)
+    center, spectrum = get_trace(shape)
+    ys = np.arange(num_rows)[:, np.newaxis]
+    gain = refs["gain"]
+    chunk = num_cols // LAYOUT["noutputs"]
+
+    #Saturating pixels, away from the trace
+    sat_rows = rng.integers(0, num_rows, SATURATED_PIXELS)
+    sat_cols = rng.integers(0, num_cols, SATURATED_PIXELS)
+
+    raw = np.empty((num_ints,) + to_raw(np.zeros((num_groups,) + shape)).shape, dtype=np.uint16)
+    for i in range(num_ints):
+        y_offset = rng.normal(0, JITTER)
+        profile = np.exp(-((ys - center - y_offset) / LAYOUT["trace_sigma"])**2 / 2)
+        flux = BKD_FLUX + light_curve[i] * spectrum * profile
+        if N_REF > 0:
+            flux[:N_REF] = 0
+            flux[:, :N_REF] = flux[:, -N_REF:] = 0
+        flux[sat_rows, sat_cols] = 3 * 65535 * gain[sat_rows, sat_cols] / num_groups
+        flux /= refs["flat"]
+
+        electrons = np.cumsum(rng.poisson(flux, (num_groups,) + shape), axis=0).astype(np.float64)
+        hits = rng.random(shape) < CR_RATE * num_groups
+        hit_grps = rng.integers(0, num_groups, np.count_nonzero(hits))
+        for (r, c), g in zip(np.argwhere(hits), hit_grps):
+            electrons[g:, r, c] += 10**rng.uniform(2, 4.5)
+
+        signal = electrons / gain + refs["dark"][:num_groups]
+        ramps = refs["superbias"] + signal - NONLINEARITY * signal**2
+        ramps += rng.normal(0, 1, ramps.shape) * refs["read_noise"]
+        #Offsets of each amplifier in each group, tracked by the ref pixels
+        offsets = rng.normal(0, 3, (num_groups, LAYOUT["noutputs"]))
+        ramps += np.repeat(offsets, chunk, axis=1)[:, np.newaxis, :num_cols]
+
+        ramps = to_raw(ramps) + get_one_over_f(rng, num_groups, shape)
+        raw[i] = np.clip(np.rint(ramps), 0, 65535)
+
+    header = astropy.io.fits.Header()
+    for key, value in dict(INSTRUME=INSTRUMENT, FILTER=FILTER, SUBARRAY=SUBARRAY, DETECTOR=LAYOUT["detector"].upper(),
+                           NFRAMES=1, GROUPGAP=0, NGROUPS=num_groups, NOUTPUTS=LAYOUT["noutputs"],
+                           INTSTART=int_start + 1, INTEND=int_start + num_ints).items():
+        header[key] = value
+    int_times = astropy.io.fits.BinTableHDU.from_columns([
+        astropy.io.fits.Column(name="integration_number", format="J", array=np.arange(int_start, int_start + num_ints) + 1),
+        astropy.io.fits.Column(name="int_mid_MJD_UTC", format="D", array=times),
+        astropy.io.fits.Column(name="int_mid_BJD_TDB", format="D", array=times)], name="INT_TIMES")
+    astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(header=header),
+                             astropy.io.fits.ImageHDU(raw, name="SCI"), int_times]).writeto(filename, overwrite=True)
+    print("Wrote", filename, raw.shape)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("--segments", type=int, default=2)
+    parser.add_argument("--ints", type=int, default=100, help="Integrations per segment")
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--transit", action="store_true", help="Inject a transit instead of an eclipse")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    refs = make_references(rng, args.groups)
+
+    num_ints = args.segments * args.ints
+    center = SYSTEM["t0"] if args.transit else SYSTEM["t0"] + SYSTEM["per"] / 2
+    times = center + (np.arange(num_ints) / num_ints - 0.5) * DURATION
+    for s in range(args.segments):
+        filename = "jw01234001001_04101_00001-seg{:03d}_{}_uncal.fits".format(s + 1, LAYOUT["detector"])
+        ints = np.s_[s * args.ints : (s + 1) * args.ints]
+        make_segment(rng, refs, os.path.join(args.output_dir, filename), times[ints], s * args.ints, args.groups, args.transit)
+
+    with open(os.path.join(args.output_dir, "synthetic.cfg"), "w") as f:
+        f.write("[DEFAULT]\n")
+        for key, value in SYSTEM.items():
+            f.write("{}: {}\n".format(key, value))
+        f.write("t_secondary: {}\n".format(SYSTEM["t0"] + SYSTEM["per"] / 2))
+        f.write("limb_dark_coeffs: [0, 0]\n")
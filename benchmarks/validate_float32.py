@@ -0,0 +1,48 @@
+#Calibrates uncal files with FLOAT_TYPE set to float64 and to float32, and
+#reports how far the float32 slopes are from the float64 ones.  The
+#differences should be far below the slope errors.
+#Usage: python benchmarks/validate_float32.py uncal_file1 [uncal_file2 ...]
+import sys
+import os
+import time
+import tempfile
+import subprocess
+import numpy as np
+import astropy.io.fits
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+#Run in a fresh process, so that calibrate picks up the overridden constant
+CALIBRATE = """import sys
+sys.path.insert(0, {!r})
+import constants
+constants.FLOAT_TYPE = {!r}
+from calibrate import calibrate_file
+calibrate_file({!r})
+"""
+
+def calibrate(filename, float_type, output_dir):
+    start = time.time()
+    subprocess.run([sys.executable, "-c", CALIBRATE.format(PACKAGE_DIR, float_type, os.path.abspath(filename))],
+                   cwd=output_dir, check=True, stdout=subprocess.DEVNULL)
+    output_filename = "rateints_" + os.path.basename(filename).replace("_uncal", "")
+    return os.path.join(output_dir, output_filename), time.time() - start
+
+
+for filename in sys.argv[1:]:
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.mkdir(os.path.join(output_dir, "float64"))
+        os.mkdir(os.path.join(output_dir, "float32"))
+        filename64, time64 = calibrate(filename, "float64", os.path.join(output_dir, "float64"))
+        filename32, time32 = calibrate(filename, "float32", os.path.join(output_dir, "float32"))
+
+        with astropy.io.fits.open(filename64) as hdul64, astropy.io.fits.open(filename32) as hdul32:
+            signal64 = hdul64["SCI"].data
+            error64 = hdul64["ERR"].data
+            diff = np.abs(hdul32["SCI"].data - signal64)
+            good = np.isfinite(error64) & (hdul64["DQ"].data == 0)
+            print(filename)
+            print("float64 took {:.1f} s, float32 took {:.1f} s".format(time64, time32))
+            print("Max slope difference {:.3g}, max relative to error {:.3g}".format(
+                np.nanmax(diff[good]), np.nanmax(diff[good] / error64[good])))
+            print("Pixels flagged differently:", np.sum((hdul64["DQ"].data != 0) != (hdul32["DQ"].data != 0)))
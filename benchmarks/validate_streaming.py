@@ -0,0 +1,65 @@
+#Calibrates uncal files whole and with --max-memory, and checks that the
+#streamed calibration stays within the budget and gives the same output.
+#The peak is what tracemalloc sees allocated, which leaves out the
+#memory-mapped scratch files.  Exits with an error if a check fails.
+#Usage: python benchmarks/validate_streaming.py max_memory_GB uncal_file1 [uncal_file2 ...] [--grps-to-sat grps_to_sat.npy]
+import sys
+import os
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import astropy.io.fits
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+#Run in a fresh process, so that nothing is cached from the other run
+CALIBRATE = """import sys
+import tracemalloc
+sys.path.insert(0, {!r})
+from calibrate import calibrate_file
+tracemalloc.start()
+calibrate_file({!r}, grps_to_sat={!r}, max_memory={!r})
+print(tracemalloc.get_traced_memory()[1])
+"""
+
+def calibrate(filename, grps_to_sat, max_memory, output_dir):
+    start = time.time()
+    result = subprocess.run([sys.executable, "-c", CALIBRATE.format(PACKAGE_DIR, os.path.abspath(filename), grps_to_sat, max_memory)],
+                            cwd=output_dir, check=True, stdout=subprocess.PIPE, text=True)
+    peak = int(result.stdout.split()[-1])
+    output_filename = "rateints_" + os.path.basename(filename).replace("_uncal", "")
+    return os.path.join(output_dir, output_filename), peak, time.time() - start
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("max_memory", type=float, help="Memory budget in GB")
+parser.add_argument("filenames", nargs="+")
+parser.add_argument("--grps-to-sat")
+args = parser.parse_args()
+max_memory = args.max_memory * 1e9
+grps_to_sat = None if args.grps_to_sat is None else os.path.abspath(args.grps_to_sat)
+
+failed = False
+for filename in args.filenames:
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.mkdir(os.path.join(output_dir, "whole"))
+        os.mkdir(os.path.join(output_dir, "streamed"))
+        whole_filename, whole_peak, whole_time = calibrate(filename, grps_to_sat, None, os.path.join(output_dir, "whole"))
+        streamed_filename, streamed_peak, streamed_time = calibrate(filename, grps_to_sat, max_memory, os.path.join(output_dir, "streamed"))
+
+        with astropy.io.fits.open(whole_filename) as whole, astropy.io.fits.open(streamed_filename) as streamed:
+            different = [hdu.name for hdu in whole if hdu.is_image and hdu.data is not None and
+                         not np.array_equal(hdu.data, streamed[hdu.name].data, equal_nan=True)]
+
+        print(filename)
+        print("Whole: peak {:.3f} GB in {:.1f} s.  Streamed: peak {:.3f} GB in {:.1f} s, budget {:.3f} GB".format(
+            whole_peak / 1e9, whole_time, streamed_peak / 1e9, streamed_time, max_memory / 1e9))
+        print("Extensions that differ:", different)
+        if streamed_peak > max_memory or different:
+            print("FAILED")
+            failed = True
+
+if failed:
+    sys.exit(1)
@@ -10,120 +10,337 @@ import pdb
 import gc
 import pdb
 import argparse
+import tempfile
+import numpy
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from numpy.lib.format import open_memmap
 from scipy.ndimage import uniform_filter
-from constants import INSTRUMENT, FILTER, SUBARRAY, TOP_MARGIN, BAD_GRPS, LEFT, RIGHT, TOP, BOT, NONLINEAR_FILE, DARK_FILE, FLAT_FILE, RNOISE_FILE, MASK_FILE, GAIN_FILE, ROTATE, SKIP_SUPERBIAS, SUPERBIAS_FILE, SKIP_FLAT, SKIP_REF, N_REF, BKD_REG_TOP, BKD_REG_BOT
+from ref_cache import load_cached
+from lazy_fits import get_rotated_shape, read_block, make_image_hdu, create_image_file, write_image_block, OUTPUT_FLOAT_TYPE
+from constants import INSTRUMENT, FILTER, SUBARRAY, TOP_MARGIN, BAD_GRPS, LEFT, RIGHT, TOP, BOT, NONLINEAR_FILE, DARK_FILE, FLAT_FILE, RNOISE_FILE, MASK_FILE, GAIN_FILE, ROTATE, SKIP_SUPERBIAS, SUPERBIAS_FILE, SKIP_FLAT, SKIP_REF, N_REF, BKD_REG_TOP, BKD_REG_BOT, FLOAT_TYPE, OUTPUT_PROFILE, COMPRESS_OUTPUT
 
-def destripe(data):
-    #data: N_int x N_grp x N_row x N_col
+#Peak number of full-size copies of a block of ramps alive at once
+#(get_slopes needs about this many)
+CUBE_COPIES = 4
+
+#Peak number of float64 frames per integration alive besides those (the
+#slope estimates, errors and masks of the fits, and their outputs)
+FRAME_COPIES = 6
+
+#Bits of the DQ of compact rateints files: bad in the reference files,
+#flagged by the ramp fit, and NaN slope.  Full files have the reference DQ
+#values instead, or'd with the other two.
+DQ_REFERENCE = 1
+DQ_RAMP = 2
+DQ_NAN = 4
+
+#Approximate size of the group differences the slope fitters handle per
+#NumPy call, which sets how many integrations are fit at once
+FIT_BLOCK_BYTES = 2**24
+
+#A pixel's slope fit is done once its outlier mask has settled and a pass
+#moves its slope by at most this fraction of its error.  The slopes are then
+#closer to the converged ones than after the fixed passes of the original
+#loop.
+FIT_TOLERANCE = 0.1
+
+#Memory get_median_residuals uses for the median over integrations, unless
+#it's given a budget (calibrate.py --median-memory)
+MEDIAN_BLOCK_BYTES = 2**27
+
+#Size of the block of ramps calibrate_ramps applies every correction to
+#before moving on, small enough to stay in cache
+PREPROCESS_BLOCK_BYTES = 2**22
+
+#Reference arrays by (NFRAMES, GROUPGAP, frame shape, number of groups),
+#kept for every later segment of the visit.  Filled in each worker of a
+#--workers run from shared memory.
+shared_references = {}
+shared_blocks = []
+
+#Optimal ramp weights are tabulated against the signal to read noise ratio
+#on a log-spaced grid and linearly interpolated in log(ratio).  Each weight is
+#asymptotically proportional to 1/ratio, so the relative interpolation error
+#is at most (ln(10) / WEIGHT_GRID_PER_DECADE)**2 / 8, which is 7e-7 for 1000
+#points per decade.  This changes the slopes by a negligible fraction of their
+#uncertainty.  Ratios are clipped to the grid, as they always were at 1e-6.
+WEIGHT_GRID_MIN = -6
+WEIGHT_GRID_MAX = 8
+WEIGHT_GRID_PER_DECADE = 1000
+weight_tables = {}
+
+def get_stripes(data):
+    #Median of the background rows of every column, N_int x N_grp x 1 x N_col
     bkd_pixels = np.concatenate((data[:,:,BKD_REG_TOP[0] : BKD_REG_TOP[1]],
                           data[:,:,BKD_REG_BOT[0] : BKD_REG_BOT[1]]),
                          axis=2)
-    bkd = np.median(bkd_pixels, axis=2)
-    return data - bkd[:,:,np.newaxis,:]
+    return np.median(bkd_pixels, axis=2)[:,:,np.newaxis,:]
+
+
+def destripe(data):
+    #data: N_int x N_grp x N_row x N_col
+    return data - get_stripes(data)
     
 
+#Reference arrays are cropped and rotated once, then memory-mapped from the
+#cache in REF_DIR (see ref_cache.py) for every later segment
+
 def get_mask():
-    with astropy.io.fits.open(MASK_FILE) as hdul:
-        mask = np.asarray(np.rot90(hdul["DQ"].data, ROTATE)[TOP:BOT, LEFT:RIGHT])
-    return mask
+    def build():
+        with astropy.io.fits.open(MASK_FILE) as hdul:
+            return (np.rot90(hdul["DQ"].data, ROTATE)[TOP:BOT, LEFT:RIGHT],)
+
+    mask, = load_cached(MASK_FILE, "mask", build)
+    #Copy, because callers OR other masks into it
+    return np.array(mask)
 
 
 def get_gain():
-    with astropy.io.fits.open(GAIN_FILE) as hdul:
-        substrt_x = int(hdul[0].header["SUBSTRT1"]) - 1
-        substrt_y = int(hdul[0].header["SUBSTRT2"]) - 1
-        gain = np.asarray(np.rot90(hdul[1].data, ROTATE)[
-            TOP-substrt_y : BOT-substrt_y,
-            LEFT-substrt_x : RIGHT-substrt_x])
-    return gain
+    def build():
+        with astropy.io.fits.open(GAIN_FILE) as hdul:
+            substrt_x = int(hdul[0].header["SUBSTRT1"]) - 1
+            substrt_y = int(hdul[0].header["SUBSTRT2"]) - 1
+            return (np.rot90(hdul[1].data, ROTATE)[
+                TOP-substrt_y : BOT-substrt_y,
+                LEFT-substrt_x : RIGHT-substrt_x],)
+
+    gain, = load_cached(GAIN_FILE, "gain", build)
+    return np.asarray(gain)
 
 
-def subtract_superbias(data):
+def get_superbias(shape):
     #There are a LOT of pixels with UNRELIABLE_BIAS flag that seem perfectly
     #fine otherwise, so we ignore the superbias DQ
-    with astropy.io.fits.open(SUPERBIAS_FILE) as hdul:
-        superbias = np.rot90(hdul[1].data, ROTATE)
-        if superbias.shape != data.shape[2:]:
-            superbias = superbias[TOP:BOT, LEFT:RIGHT]
-        
-    superbias[np.isnan(superbias)] = 0
+    def build():
+        with astropy.io.fits.open(SUPERBIAS_FILE) as hdul:
+            superbias = np.array(np.rot90(hdul[1].data, ROTATE))
+            if superbias.shape != shape:
+                superbias = superbias[TOP:BOT, LEFT:RIGHT]
+
+        superbias[np.isnan(superbias)] = 0
+        return (superbias,)
+
+    superbias, = load_cached(SUPERBIAS_FILE, "superbias", build, shape)
+    return np.asarray(superbias)
+
+
+def subtract_superbias(data, superbias=None):
+    if superbias is None:
+        superbias = get_superbias(data.shape[2:])
     return data - superbias
 
 
 def subtract_ref(data, noutputs):
-    result = np.copy(data)
-    chunk_size = int(data.shape[-1] / hdul[0].header["NOUTPUTS"])
+    #Subtracts the reference pixels in place.  data: N_int x N_grp x N_row x N_col
+    chunk_size = int(data.shape[-1] / noutputs)
+    num_chunks = data.shape[-1] // chunk_size
 
-    #Subtract ref along top
-    for c in range(int(data.shape[-1]/chunk_size)):
-        c_min = c * chunk_size
-        c_max = (c + 1) * chunk_size
-        mean = np.mean(data[:,:,:N_REF,c_min:c_max], axis=(2,3))
-        result[:,:,:,c_min:c_max] -= mean[:,:,np.newaxis,np.newaxis]
+    #Subtract ref along top, for every amplifier at once.  Splitting the last
+    #axis gives a view, N_int x N_grp x N_row x amplifier x column
+    amplifiers = data[..., :num_chunks * chunk_size].reshape(data.shape[:-1] + (num_chunks, chunk_size))
+    mean = np.mean(amplifiers[:,:,:N_REF], axis=(2,4), dtype=np.float64)
+    amplifiers -= mean[:,:,np.newaxis,:,np.newaxis]
 
     #Subtract ref along sides
-    mean = np.mean(result[:,:,:,:N_REF], axis=3) / 2 + np.mean(result[:,:,:,-N_REF:], axis=3) / 2
-    result -= mean[:,:,:,np.newaxis]
-    return result
+    mean = np.mean(data[:,:,:,:N_REF], axis=3, dtype=np.float64) / 2 + np.mean(data[:,:,:,-N_REF:], axis=3, dtype=np.float64) / 2
+    data -= mean[:,:,:,np.newaxis]
+    return data
+
+
+def get_nonlinearity():
+    def build():
+        with astropy.io.fits.open(NONLINEAR_FILE) as hdul:
+            substrt_x = int(hdul[0].header["SUBSTRT1"]) - 1
+            substrt_y = int(hdul[0].header["SUBSTRT2"]) - 1
+            coeffs = np.array(np.rot90(hdul[1].data, ROTATE, (-2,-1))[:,
+                TOP-substrt_y : BOT-substrt_y,
+                LEFT-substrt_x : RIGHT-substrt_x], dtype=np.float64)
+            dq = np.array(np.rot90(hdul["DQ"].data, ROTATE)[
+                TOP-substrt_y : BOT-substrt_y,
+                LEFT-substrt_x : RIGHT-substrt_x])
+        return coeffs, dq > 0
+
+    coeffs, mask = load_cached(NONLINEAR_FILE, "nonlinearity", build)
+    return np.asarray(coeffs), np.asarray(mask)
+
 
+def horner_in_place(x, coeffs, result):
+    #Overwrites x with the polynomial with coefficients coeffs (lowest order
+    #first) evaluated at x, using result, of the same shape, as scratch space
+    result[:] = coeffs[-1]
+    for c in coeffs[-2::-1]:
+        result *= x
+        result += c
+    x[:] = result
 
-def apply_nonlinearity(data):   
+
+def apply_nonlinearity(data, nonlinearity=None, block_bytes=2**27):
+    #Evaluates the polynomial with Horner's scheme and overwrites data with
+    #the result.  This is done a block of integrations at a time, so the only
+    #scratch space needed is one block of about block_bytes.
     start = time.time()
+    if nonlinearity is None:
+        nonlinearity = get_nonlinearity()
+    coeffs, mask = nonlinearity
+
+    if data.dtype not in (np.float32, np.float64):
+        data = np.array(data, dtype=FLOAT_TYPE)
+    block_size = max(1, int(block_bytes // (data[0].size * data.itemsize)))
+    acc = np.empty((min(block_size, len(data)),) + data.shape[1:], dtype=data.dtype)
+
+    for i in range(0, len(data), block_size):
+        x = data[i : i + block_size]
+        horner_in_place(x, coeffs, acc[:len(x)])
 
-    with astropy.io.fits.open(NONLINEAR_FILE) as hdul:
-        substrt_x = int(hdul[0].header["SUBSTRT1"]) - 1
-        substrt_y = int(hdul[0].header["SUBSTRT2"]) - 1
-        coeffs = np.array(np.rot90(hdul[1].data, ROTATE, (-2,-1))[:,
-            TOP-substrt_y : BOT-substrt_y,
-            LEFT-substrt_x : RIGHT-substrt_x], dtype=np.float64)
-        dq = np.array(np.rot90(hdul["DQ"].data, ROTATE)[
-            TOP-substrt_y : BOT-substrt_y,
-            LEFT-substrt_x : RIGHT-substrt_x])
-                      
-        result = np.zeros(data.shape, dtype=np.float64)
-        exp_data = np.ones(data.shape, dtype=np.float64)
-        
-        for i in range(len(coeffs)):
-            print(i)
-            result += coeffs[i] * exp_data
-            exp_data *= data
     end = time.time()
     print("Non linearity took", end - start)
-    return result, dq > 0
+    return data, mask
 
 
-def subtract_dark(data, nframes, groupgap):
-    with astropy.io.fits.open(DARK_FILE) as hdul:
-        dark = np.array(np.rot90(hdul[1].data, ROTATE, (-2,-1)), dtype=np.float64)
-        dq = np.array(np.rot90(hdul["DQ"].data, ROTATE, (-2,-1)))
-        if dark.ndim == 4:
-            print("Warning: skipping first {} integrations of dark".format(dark.shape[0] - 1))
-            dark = dark[-1]
-            dq = dq[0,0]
-    
-    #Make dark frame the right size
-    if not (nframes == 1 and groupgap == 0):
-        assert(nframes == 1 or (nframes/2).is_integer())
-        total_frames = nframes + groupgap
-        indices = np.arange(dark.shape[0]) % total_frames
-        include = indices < nframes
-        trunc_dark = dark[include]
-        final_dark = uniform_filter(trunc_dark, [nframes,1,1])[int(nframes/2)::nframes]
-    else:
-        final_dark = dark
-        
+def get_dark(nframes, groupgap, ngroups=None):
+    #Group-averaged dark for the first ngroups groups, in FLOAT_TYPE so that
+    #it's subtracted straight from the memory-mapped cache
+    def build():
+        with astropy.io.fits.open(DARK_FILE) as hdul:
+            dark = np.array(np.rot90(hdul[1].data, ROTATE, (-2,-1)), dtype=np.float64)
+            dq = np.array(np.rot90(hdul["DQ"].data, ROTATE, (-2,-1)))
+            if dark.ndim == 4:
+                print("Warning: skipping first {} integrations of dark".format(dark.shape[0] - 1))
+                dark = dark[-1]
+                dq = dq[0,0]
+
+        #Make dark frame the right size
+        if not (nframes == 1 and groupgap == 0):
+            assert(nframes == 1 or (nframes/2).is_integer())
+            total_frames = nframes + groupgap
+            indices = np.arange(dark.shape[0]) % total_frames
+            include = indices < nframes
+            trunc_dark = dark[include]
+            final_dark = uniform_filter(trunc_dark, [nframes,1,1])[int(nframes/2)::nframes]
+        else:
+            final_dark = dark
+        assert(ngroups is None or ngroups <= final_dark.shape[0])
+        final_dark = np.array(final_dark[:ngroups], dtype=FLOAT_TYPE)
+
+        if INSTRUMENT == "NIRSPEC":
+            #NIRSPEC dark mask has a lot of DQ flags, most of which don't seem to be reflected in actual data anomalies
+            mask = np.zeros(dq.shape, dtype=bool)
+        else:
+            mask = dq > 0
+        return final_dark, mask
+
+    final_dark, mask = load_cached(DARK_FILE, "dark", build, (nframes, groupgap, ngroups, FLOAT_TYPE))
+    return np.asarray(final_dark), np.asarray(mask)
+
+
+def subtract_dark(data, nframes, groupgap, dark=None):
+    if dark is None:
+        dark = get_dark(nframes, groupgap, data.shape[1])
+    final_dark, mask = dark
     assert(data.shape[1] <= final_dark.shape[0])
-    
-    result = data - final_dark[:data.shape[1]]
-    if INSTRUMENT == "NIRSPEC":
-        #NIRSPEC dark mask has a lot of DQ flags, most of which don't seem to be reflected in actual data anomalies
-        mask = np.zeros(dq.shape, dtype=bool)
-    else:
-        mask = dq > 0
-    return result, mask
 
+    data -= final_dark[:data.shape[1]]
+    return data, mask
+
+
+def get_median_rows(shape, max_memory):
+    #Number of rows get_median_residuals can take the median of at once
+    #within max_memory bytes.  Its output comes first; then each row needs
+    #its residuals, its signal, and its median (and the middle pair that is
+    #averaged for an even number of integrations).
+    N_int, N_grp, N_row, N_col = shape
+    left = max_memory - N_grp * N_row * N_col * 8
+    bytes_per_row = (N_int * N_grp + N_int + 3 * N_grp) * N_col * 8
+    return max(1, min(N_row, int(left // bytes_per_row)))
+
+
+def get_median_residuals(ramps, signal, max_memory=None):
+    #ramps: N_int x N_grp x N_row x N_col, possibly a memory-mapped cube
+    #Median over integrations is taken a block of rows at a time, which gives
+    #exactly the same answer as taking it over the whole cube.  The block of
+    #residuals is the only full-size temporary: a single buffer, filled in
+    #place for each block and partitioned in place by the median.
+    #max_memory: bytes for the output and temporaries, MEDIAN_BLOCK_BYTES by
+    #default
+    N_int, N_grp, N_row, N_col = ramps.shape
+    if N_grp == 2:
+        return np.zeros(ramps.shape[1:])
+    if max_memory is None:
+        max_memory = MEDIAN_BLOCK_BYTES
+    max_rows = get_median_rows(ramps.shape, max_memory)
+
+    minus_grps = -np.arange(N_grp)[:,np.newaxis,np.newaxis]
+    median_residuals = np.zeros(ramps.shape[1:])
+    #Flat, so that a short last block is contiguous too (np.median copies
+    #non-contiguous input despite overwrite_input)
+    block = np.empty(N_int * N_grp * max_rows * N_col)
+    for r in range(0, N_row, max_rows):
+        rows = np.s_[r : r + max_rows]
+        num_rows = min(max_rows, N_row - r)
+        residuals = block[:N_int * N_grp * num_rows * N_col].reshape(N_int, N_grp, num_rows, N_col)
+        np.multiply(np.asarray(signal[:,rows], dtype=np.float64)[:,np.newaxis], minus_grps, out=residuals)
+        residuals += np.asarray(ramps[:,:,rows])
+        median_residuals[:,rows] = np.median(residuals, axis=0, overwrite_input=True)
+
+    median_residuals -= np.median(median_residuals, axis=0)
+    return median_residuals
+
+
+def get_optimal_weights(ratio, N):
+    #Exact weights of the N differences for a ratio of signal per group to
+    #read noise squared, up to a factor of read noise**-2.  ratio: any shape
+    j = np.array(np.arange(1, N + 1), dtype=np.float64)
+    l = np.arccosh(1 + ratio/2)[..., np.newaxis]
+    #weights = j*(j - N - 1)/2
+    #weights = -np.exp(l) * (1 - np.exp(-j*l)) * (np.exp(j*l - l*N) - np.exp(l)) / (np.exp(l) - 1)**2 / (np.exp(l) + np.exp(-l*N))
+    return -ne.evaluate("exp(l) * (1 - exp(-j*l)) * (exp(j*l - l*N) - exp(l)) / (exp(l) - 1)**2 / (exp(l) + exp(-l*N))")
+
+
+def get_weight_table(N):
+    #Returns the weights on the ratio grid, and their differences between
+    #neighbouring grid points
+    if N not in weight_tables:
+        ratios = 10**np.linspace(WEIGHT_GRID_MIN, WEIGHT_GRID_MAX, (WEIGHT_GRID_MAX - WEIGHT_GRID_MIN) * WEIGHT_GRID_PER_DECADE + 1)
+        table = get_optimal_weights(ratios, N)
+        weight_tables[N] = table, np.diff(table, axis=0)
+    return weight_tables[N]
 
-def get_slopes_initial(after_gain, read_noise):
+
+def get_weights(ratio, R, N):
+    #Interpolated optimal weights, shape ratio.shape + (N,)
+    table, diffs = get_weight_table(N)
+    x = (np.log10(np.clip(ratio, 10.**WEIGHT_GRID_MIN, 10.**WEIGHT_GRID_MAX)) - WEIGHT_GRID_MIN) * WEIGHT_GRID_PER_DECADE
+    #NaN ratios give NaN weights, as the exact formula does
+    k = np.clip(np.nan_to_num(x).astype(int), 0, len(diffs) - 1)
+    weights = np.take(table, k, axis=0)
+    correction = np.take(diffs, k, axis=0)
+    correction *= (x - k)[..., np.newaxis]
+    weights += correction
+    weights *= (R**-2)[..., np.newaxis]
+    return weights
+
+
+def get_fit_block_size(N_pix, N, block_size=None):
+    #Number of integrations the slope fitters handle per NumPy call
+    if block_size is None:
+        block_size = FIT_BLOCK_BYTES // (N_pix * N * 8)
+    return max(1, int(block_size))
+
+
+def get_pixel_diffs(cutout, block_size):
+    #Group differences laid out pixel-major, N_int x N_pix x N, so that each
+    #pixel's differences are contiguous.  Built a block at a time to avoid a
+    #second full-size temporary.
+    N_int, N_grp = cutout.shape[:2]
+    diffs = np.empty((N_int, cutout[0, 0].size, N_grp - 1), dtype=cutout.dtype)
+    for i in range(0, N_int, block_size):
+        block = np.diff(cutout[i : i + block_size], axis=1)
+        diffs[i : i + block_size] = np.moveaxis(block, 1, -1).reshape(len(block), -1, N_grp - 1)
+    return diffs
+
+
+def get_slopes_initial(after_gain, read_noise, residuals=True, block_size=None, median_memory=None):
     N_grp = after_gain.shape[1]
     if N_grp > 3 and INSTRUMENT=="MIRI":
         ignore_last = 1
@@ -131,139 +348,303 @@ def get_slopes_initial(after_gain, read_noise):
         ignore_last = 0
 
     N = N_grp - 1 - ignore_last 
-    j = np.array(np.arange(1, N + 1), dtype=np.float64)
 
-    R = read_noise[TOP_MARGIN:]
+    R = read_noise[TOP_MARGIN:].ravel()
     cutout = after_gain[:,:N_grp-ignore_last,TOP_MARGIN:] #reject last group
-    
-    signal_estimate = (cutout[:,-1] - cutout[:, 0]) / N
+    N_int, _, N_row, N_col = cutout.shape
+    block_size = get_fit_block_size(N_row * N_col, N, block_size)
+
+    signal_estimate = ((cutout[:,-1] - cutout[:, 0]) / N).reshape(N_int, -1)
     error = np.zeros(signal_estimate.shape)
-    diff_array = np.diff(cutout, axis=1)
-    noise = np.sqrt(2*R[np.newaxis,]**2 + np.absolute(signal_estimate))
-
-    for i in range(len(cutout)):
-        ratio_estimate = signal_estimate[i]  / R**2
-        ratio_estimate[ratio_estimate < 1e-6] = 1e-6
-        l = np.arccosh(1 + ratio_estimate/2)[:, :, np.newaxis]
-
-        #weights = -R[:,:,np.newaxis]**-2 * -np.ones(len(j))
-        #weights = -R[:,:,np.newaxis]**-2 * j*(j - N - 1)/2
-        weights = -R[:,:,np.newaxis]**-2 * ne.evaluate("exp(l) * (1 - exp(-j*l)) * (exp(j*l - l*N) - exp(l)) / (exp(l) - 1)**2 / (exp(l) + exp(-l*N))")
-        #weights = -R[:,:,np.newaxis]**-2 * np.exp(l) * (1 - np.exp(-j*l)) * (np.exp(j*l - l*N) - np.exp(l)) / (np.exp(l) - 1)**2 / (np.exp(l) + np.exp(-l*N))
+    diff_array = get_pixel_diffs(cutout, block_size)
+
+    for i in range(0, N_int, block_size):
+        diffs = diff_array[i : i + block_size]
+        weights = get_weights(signal_estimate[i : i + block_size] / R**2, R, N)
         #weights[:,:,0:5] = 0
         #weights[:,:,-1] = 0
-        signal_estimate[i] = np.sum(diff_array[i].transpose(1,2,0) * weights, axis=2) / np.sum(weights, axis=2)                
-        error[i] = 1. / np.sqrt(np.sum(weights, axis=2))
+        weights_sum = weights @ np.ones(N)
+        signal_estimate[i : i + block_size] = np.einsum("ijk,ijk->ij", diffs, weights) / weights_sum
+        error[i : i + block_size] = 1. / np.sqrt(weights_sum)
 
     #Fill in borders in order to maintain size    
-    full_signal_estimate = (after_gain[:, -1] - after_gain[:, 0]) / N
-    full_signal_estimate[:,TOP_MARGIN:] = signal_estimate
+    full_signal_estimate = np.array(after_gain[:, -1] - after_gain[:, 0], dtype=np.float64) / N
+    full_signal_estimate[:,TOP_MARGIN:] = signal_estimate.reshape(N_int, N_row, N_col)
         
     full_error = np.ones(full_signal_estimate.shape) * np.inf
-    full_error[:,TOP_MARGIN:] = error
+    full_error[:,TOP_MARGIN:] = error.reshape(N_int, N_row, N_col)
 
-    if N_grp == 2:
-        median_residuals = np.zeros(after_gain.shape[1:])
-    else:
-        residuals = after_gain - (full_signal_estimate*np.arange(N_grp)[:,np.newaxis,np.newaxis,np.newaxis]).transpose((1,0,2,3))
-        median_residuals = np.median(residuals, axis=0)
-        median_residuals -= np.median(median_residuals, axis=0)
+    median_residuals = None
+    if residuals:
+        median_residuals = get_median_residuals(after_gain, full_signal_estimate, median_memory)
 
     return full_signal_estimate, full_error, median_residuals
 
 
-def get_slopes(after_gain, read_noise, max_iter=50, sigma=14, bad_grps=0):
-    N_grp = after_gain.shape[1]
-    N = N_grp - 1 - bad_grps
-    j = np.array(np.arange(1, N + 1), dtype=np.float64)
+def get_outliers(diffs, signal, noise, sigma):
+    #Differences more than sigma times the noise away from the signal.
+    #diffs: N_pix x N; signal, noise: N_pix
+    z_scores = (diffs - signal[:, np.newaxis]) / noise[:, np.newaxis]
+    return np.absolute(z_scores) > sigma
 
-    R = read_noise[TOP_MARGIN:]
-    cutout = after_gain[:,bad_grps:,TOP_MARGIN:]
 
-    diff_array = np.diff(cutout, axis=1)
-    signal_estimate = np.clip(np.median(diff_array, axis=1), 0, None)
-    error = np.zeros(signal_estimate.shape)
-    noise = np.sqrt(2*R[np.newaxis,]**2 + signal_estimate)
-    bad_mask = np.zeros(diff_array.shape, dtype=bool)
-    pixel_bad_mask = np.zeros(signal_estimate.shape, dtype=bool)
+def fit_pixels(diffs, R, signal, noise, N, sigma, bad_mask=None):
+    #One iteration of outlier rejection and optimally weighted fitting.
+    #diffs: N_pix x N group differences; R, signal, noise: N_pix
+    #Returns the new signal and error, the outlier mask (N_pix x N), and which
+    #pixels are entirely bad and which are too often bad.  bad_mask, if
+    #given, is used instead of the outliers of signal
+    weights = get_weights(signal / R**2, R, N)
+
+    #Find cosmic rays and other anomalies
+    if bad_mask is None:
+        bad_mask = get_outliers(diffs, signal, noise, sigma)
+    weights[bad_mask] = 0
+    #Sums over the short last axis are much faster with einsum.  Unlike
+    #matrix products, they don't depend on which other pixels are fit at the
+    #same time, which changes from pass to pass.
+    weights_sum = np.einsum("ij->i", weights)
+    all_bad = weights_sum == 0
+    weights[all_bad] += 1
+    weights_sum[all_bad] = N
+    slightly_bad = np.count_nonzero(bad_mask, axis=1) > sigma
+
+    signal = np.einsum("ij,ij->i", diffs, weights) / weights_sum
+    error = 1. / np.sqrt(weights_sum)
+    return signal, error, bad_mask, all_bad, slightly_bad
+
+
+def prescreen_jumps(diffs, R, N, sigma):
+    #Flags jumps and estimates the signal before the weighted passes, without
+    #their signal-dependent weights.  Differences more than sigma times the
+    #noise expected from the read noise and the median difference (at least
+    #0) away from the median are jumps.  The rest are averaged with the
+    #optimal weights of a read noise dominated ramp, which are the same for
+    #every pixel, so the first weighted pass starts close to its result.
+    #diffs: N_pix x N; R: N_pix.  Returns the signal estimate, the noise and
+    #the outlier mask.
+    median = np.clip(np.median(diffs, axis=1), 0, None)
+    noise = np.sqrt(2*R**2 + median)
+    bad_mask = get_outliers(diffs, median, noise, sigma)
+    weights = np.where(bad_mask, 0, get_weight_table(N)[0][0])
+    weights_sum = np.einsum("ij->i", weights)
+    all_bad = weights_sum == 0
+    weights_sum[all_bad] = 1
+    signal = np.einsum("ij,ij->i", diffs, weights) / weights_sum
+    signal[all_bad] = median[all_bad]
+    return signal, noise, bad_mask
+
+
+def get_active_batches(active, batch_size):
+    #Indices of the True entries of active, in batches of at least
+    #batch_size (except the last), so that the sparse late passes of
+    #fit_diffs still fit many pixels per NumPy call
+    batch = []
+    num = 0
+    for c in range(0, len(active), batch_size):
+        indices = c + np.nonzero(active[c : c + batch_size])[0]
+        batch.append(indices)
+        num += len(indices)
+        if num >= batch_size:
+            yield np.concatenate(batch)
+            batch = []
+            num = 0
+    if num > 0:
+        yield np.concatenate(batch)
+
+
+def new_fit(num, N):
+    #Per-pixel state of the passes of fit_diffs, for num pixels with N group
+    #differences each
+    return {name: np.empty(shape, dtype=dtype) for name, shape, dtype in [
+        ("signal", (num,), np.float64), ("noise", (num,), np.float64), ("error", (num,), np.float64),
+        ("bad_mask", (num, N), bool), ("pixel_bad_mask", (num,), bool), ("active", (num,), bool)]}
+
 
+def fit_pass(diff_array, R, N, sigma, block_size, fit, first=False):
+    #One pass of outlier rejection and fitting over the active pixels of fit
+    #(from new_fit), block_size integrations' worth at a time.  Each pixel is
+    #fit with the weights and outlier mask of its signal estimate, except in
+    #the first pass, which starts from the pre-screen: its signal estimate
+    #for the weights, and its mask.  A pixel is done once it was fit with the
+    #mask of the estimate its weights came from, the outliers of its new
+    #estimate are that mask too, and the estimate moved by at most
+    #FIT_TOLERANCE times its error, so that another pass would only refine
+    #its weights a little; otherwise it stays active.
+    #diff_array: N_int * N_pix x N, indexed by integration * N_pix + pixel;
+    #R: N_pix.  Returns the number of changes the next pass would make to the
+    #masks, the number of pixels still active, and the indices of the pixels
+    #for which every group difference was rejected
+    N_pix = len(R)
+    chunk_size = block_size * N_pix
+    if first:
+        #Slices of whole integrations, so that everything is a view
+        batches = [np.s_[c : c + chunk_size] for c in range(0, len(diff_array), chunk_size)]
+    else:
+        batches = get_active_batches(fit["active"], chunk_size)
+
+    num_changed = 0
+    num_active = 0
+    all_bad = [np.zeros(0, dtype=int)]
+    for indices in batches:
+        diffs = diff_array[indices]
+        if first:
+            pixel_R = np.tile(R, len(diffs) // N_pix)
+            fit["signal"][indices], fit["noise"][indices], fit["bad_mask"][indices] = prescreen_jumps(diffs, pixel_R, N, sigma)
+            fit["pixel_bad_mask"][indices] = False
+        else:
+            pixel_R = R[indices % N_pix]
+
+        noise = fit["noise"][indices]
+        old_signal = fit["signal"][indices]
+        old_mask = fit["bad_mask"][indices]
+        signal, error, bad_mask, entirely_bad, slightly_bad = fit_pixels(
+            diffs, pixel_R, old_signal, noise, N, sigma, old_mask if first else None)
+        changed = get_outliers(diffs, signal, noise, sigma) != bad_mask
+        num_changed += np.count_nonzero(changed)
+        active = np.any(changed | (bad_mask != old_mask), axis=1) | (np.abs(signal - old_signal) > FIT_TOLERANCE * error)
+        num_active += np.count_nonzero(active)
+
+        fit["active"][indices] = active
+        fit["signal"][indices] = signal
+        fit["error"][indices] = error
+        fit["pixel_bad_mask"][indices] |= entirely_bad | slightly_bad
+        fit["bad_mask"][indices] = bad_mask
+        if first:
+            all_bad.append(indices.start + np.nonzero(entirely_bad)[0])
+        else:
+            all_bad.append(indices[entirely_bad])
+    return num_changed, num_active, np.concatenate(all_bad)
+
+
+def iterate_fit(fit_pass, max_iter):
+    #Runs fit_pass(first) until no pixel is active, or for max_iter passes.
+    #Returns the indices of the pixels for which every group difference was
+    #rejected
+    all_bad = []
     for iteration in range(max_iter):
-        old_bad_mask = np.copy(bad_mask)
-        for i in range(len(cutout)):
-            ratio_estimate = signal_estimate[i]  / R**2
-            ratio_estimate[ratio_estimate < 1e-6] = 1e-6
-            l = np.arccosh(1 + ratio_estimate/2)[:, :, np.newaxis]
-            #weights = -R[:,:,np.newaxis]**-2 * j*(j - N - 1)/2
-            weights = -R[:,:,np.newaxis]**-2 * ne.evaluate("exp(l) * (1 - exp(-j*l)) * (exp(j*l - l*N) - exp(l)) / (exp(l) - 1)**2 / (exp(l) + exp(-l*N))")
-            #weights = -R[:,:,np.newaxis]**-2 * np.exp(l) * (1 - np.exp(-j*l)) * (np.exp(j*l - l*N) - np.exp(l)) / (np.exp(l) - 1)**2 / (np.exp(l) + np.exp(-l*N))
-            #weights[:,:,:BAD_GRPS] = 0
-            #weights[:,:,-1] = 0
-            
-            #Find cosmic rays and other anomalies
-            z_scores = (diff_array[i] - signal_estimate[i, np.newaxis]) / noise[i, np.newaxis]
-            bad_mask[i] = np.absolute(z_scores) > sigma
-            weights[bad_mask[i].transpose(1,2,0)] = 0
-            weights_sum = np.sum(weights, axis=2)
-            if np.sum(weights_sum == 0) > 0:
-                bad_pos = np.nonzero(weights_sum == 0)
-                print("These pixels are bad in integration {}: y,x={}".format(i, bad_pos))
-                pixel_bad_mask[i][bad_pos] = True
-                weights[bad_pos] += 1
-
-            slightly_bad = np.sum(bad_mask[i], axis=0) > sigma
-            pixel_bad_mask[i][slightly_bad] = True
-                
-            signal_estimate[i] = np.sum(diff_array[i].transpose(1,2,0) * weights, axis=2) / np.sum(weights, axis=2)
-            error[i] = 1. / np.sqrt(np.sum(weights, axis=2))
-
-        num_changed = np.sum(old_bad_mask != bad_mask)
-        if num_changed == 0:
+        num_changed, num_active, bad = fit_pass(iteration == 0)
+        all_bad.append(bad)
+        if num_active == 0:
             break
-        print("Num changed", iteration, num_changed)
-        gc.collect()
+        print("Num changed", iteration, num_changed, "active pixels", num_active)
+    return np.concatenate(all_bad)
+
+
+def fit_diffs(diff_array, R, N, max_iter, sigma, block_size):
+    #Iterated outlier rejection and fitting of group differences.
+    #diff_array: N_int * N_pix x N, indexed by integration * N_pix + pixel;
+    #R: N_pix.  Returns the signal, error, bad pixel mask, and the indices of
+    #the pixels for which every group difference was rejected
+    fit = new_fit(len(diff_array), N)
+    all_bad = iterate_fit(lambda first: fit_pass(diff_array, R, N, sigma, block_size, fit, first), max_iter)
+    return fit["signal"], fit["error"], fit["pixel_bad_mask"], all_bad
+
+
+def get_slope_diffs(after_gain, read_noise, bad_grps=0, block_size=None):
+    #Group differences of the pixels get_slopes fits, as fit_diffs takes
+    #them, their read noise, and the number of integrations to fit per NumPy
+    #call
+    N = after_gain.shape[1] - 1 - bad_grps
+    cutout = after_gain[:,bad_grps:,TOP_MARGIN:]
+    block_size = get_fit_block_size(cutout[0, 0].size, N, block_size)
+    return get_pixel_diffs(cutout, block_size).reshape(-1, N), read_noise[TOP_MARGIN:].ravel(), block_size
+
+
+def fill_borders(after_gain, N, signal_estimate, error, pixel_bad_mask):
+    #Full frames of the signal, error and bad pixel mask from those of the
+    #pixels get_slopes fits
+    N_int, _, N_row, N_col = after_gain.shape
+    full_signal_estimate = np.array(after_gain[:, -1] - after_gain[:, 0], dtype=np.float64) / N
+    full_signal_estimate[:,TOP_MARGIN:] = signal_estimate.reshape(N_int, -1, N_col)
 
-    #Fill in borders in order to maintain size
-    full_signal_estimate = (after_gain[:, -1] - after_gain[:, 0]) / N
-    full_signal_estimate[:,TOP_MARGIN:] = signal_estimate
-        
     full_error = np.ones(full_signal_estimate.shape) * np.inf
-    full_error[:,TOP_MARGIN:] = error
+    full_error[:,TOP_MARGIN:] = error.reshape(N_int, -1, N_col)
 
     full_pixel_mask = np.zeros(full_signal_estimate.shape, dtype=bool)
-    full_pixel_mask[:,TOP_MARGIN:] = pixel_bad_mask
+    full_pixel_mask[:,TOP_MARGIN:] = pixel_bad_mask.reshape(N_int, -1, N_col)
+    return full_signal_estimate, full_error, full_pixel_mask
+
+
+def get_bad_pixels(all_bad, frame_shape):
+    #N_bad x 3 array of (integration, row, column) of the pixels with the
+    #given indices into get_slopes' fits
+    N_row, N_col = frame_shape
+    ints, pixels = np.divmod(all_bad, (N_row - TOP_MARGIN) * N_col)
+    return np.unique(np.stack([ints, pixels // N_col + TOP_MARGIN, pixels % N_col], axis=1), axis=0)
+
+
+def get_slopes(after_gain, read_noise, max_iter=50, sigma=14, bad_grps=0, residuals=True, block_size=None, median_memory=None):
+    #Returns the signal, error, a mask of bad pixels, the median residuals,
+    #and an N_bad x 3 array of (integration, row, column) of the pixels for
+    #which every group difference was rejected
+    diff_array, R, block_size = get_slope_diffs(after_gain, read_noise, bad_grps, block_size)
+    N = diff_array.shape[1]
+    signal_estimate, error, pixel_bad_mask, all_bad = fit_diffs(diff_array, R, N, max_iter, sigma, block_size)
 
     #Free some memory
-    cutout = None
     diff_array = None
-    bad_mask = None
     gc.collect()
 
-    if N_grp == 2:
-        median_residuals = np.zeros(after_gain.shape)
-    else:
-        residuals = after_gain - (full_signal_estimate*np.arange(N_grp)[:,np.newaxis,np.newaxis,np.newaxis]).transpose((1,0,2,3))
-        median_residuals = np.median(residuals, axis=0)
-        median_residuals -= np.median(median_residuals, axis=0)
-    return full_signal_estimate, full_error, full_pixel_mask, median_residuals
+    full_signal_estimate, full_error, full_pixel_mask = fill_borders(after_gain, N, signal_estimate, error, pixel_bad_mask)
+    bad_pixels = get_bad_pixels(all_bad, after_gain.shape[2:])
 
+    median_residuals = None
+    if residuals:
+        median_residuals = get_median_residuals(after_gain, full_signal_estimate, median_memory)
+    return full_signal_estimate, full_error, full_pixel_mask, median_residuals, bad_pixels
 
-def set_slopes_saturated(after_gain, signal, grps_to_sat):
-    grps_to_sat = np.load(grps_to_sat)
-        
-    for i in range(after_gain.shape[0]):
-        for g in range(after_gain.shape[1] - 1, 1, -1):
-            saturated = grps_to_sat <= g
-            original = np.copy(signal[i])
-            signal[i, saturated] = (after_gain[i, g-1, saturated] - after_gain[i, 0, saturated]) / (g - 1)
+
+def get_fit_lengths(N_grp, grps_to_sat=None):
+    #Numbers of group differences the slope fits of a segment use, those of
+    #get_slopes_initial and get_slopes, and those of set_slopes_saturated if
+    #grps_to_sat is given
+    lengths = {N_grp - 1}
+    if N_grp > 3 and INSTRUMENT=="MIRI":
+        lengths.add(N_grp - 2)
+    if grps_to_sat is not None:
+        grps_to_sat = np.maximum(grps_to_sat[TOP_MARGIN:], 2)
+        lengths.update(int(n) - 1 for n in np.unique(grps_to_sat[grps_to_sat < N_grp]))
+    return sorted(lengths)
+
+
+def set_slopes_saturated(after_gain, read_noise, signal, error, grps_to_sat, max_iter=50, sigma=14):
+    #Refits pixels that saturate, using only the groups before saturation
+    #(at least two).  Pixels with the same number of unsaturated groups are
+    #fit together, with the same outlier rejection and weighting as
+    #get_slopes.  Modifies signal and error in place.  Like get_slopes, it
+    #leaves the rows above TOP_MARGIN as fill_borders set them.
+    N_int, N_grp = after_gain.shape[:2]
+    grps_to_sat = np.maximum(grps_to_sat, 2)
+    grps_to_sat[:TOP_MARGIN] = N_grp
+
+    for n in np.unique(grps_to_sat[grps_to_sat < N_grp]):
+        rows, cols = np.nonzero(grps_to_sat == n)
+        N = int(n) - 1
+        #N_int x N x N_pix -> N_int * N_pix x N
+        diffs = np.diff(after_gain[:, :n, rows, cols], axis=1)
+        diffs = np.moveaxis(diffs, 1, -1).reshape(-1, N)
+        block_size = get_fit_block_size(len(rows), N)
+        pixel_signal, pixel_error, _, _ = fit_diffs(diffs, read_noise[rows, cols], N, max_iter, sigma, block_size)
+        signal[:, rows, cols] = pixel_signal.reshape(N_int, -1)
+        error[:, rows, cols] = pixel_error.reshape(N_int, -1)
 
             
-def apply_flat(signal, error, include_flat_error=False):
-    with astropy.io.fits.open(FLAT_FILE) as hdul:
-        flat = np.array(np.rot90(hdul["SCI"].data, ROTATE), dtype=np.float64)
-        flat_err = np.array(np.rot90(hdul["ERR"].data, ROTATE), dtype=np.float64)
+def get_flat():
+    def build():
+        with astropy.io.fits.open(FLAT_FILE) as hdul:
+            flat = np.array(np.rot90(hdul["SCI"].data, ROTATE), dtype=np.float64)
+            flat_err = np.array(np.rot90(hdul["ERR"].data, ROTATE), dtype=np.float64)
+        invalid = np.isnan(flat)
+        flat[invalid] = 1
+        return flat, flat_err, invalid
+
+    flat, flat_err, invalid = load_cached(FLAT_FILE, "flat", build)
+    return np.asarray(flat), np.asarray(flat_err), np.asarray(invalid)
+
 
-    invalid = np.isnan(flat)
-    flat[invalid] = 1
+def apply_flat(signal, error, include_flat_error=False):
+    flat, flat_err, invalid = get_flat()
     final_signal = signal / flat
     if include_flat_error:
         final_error = np.sqrt((error / flat)**2 + final_signal**2 * flat_err**2)
@@ -273,75 +654,418 @@ def apply_flat(signal, error, include_flat_error=False):
     return final_signal, final_error, flat_err
 
 
-def get_read_noise(gain):    
-    with astropy.io.fits.open(RNOISE_FILE) as hdul:
-        substrt_x = int(hdul[0].header["SUBSTRT1"]) - 1
-        substrt_y = int(hdul[0].header["SUBSTRT2"]) - 1
-        return gain * np.array(np.rot90(hdul[1].data, ROTATE)[
-            TOP-substrt_y : BOT-substrt_y,
-            LEFT-substrt_x : RIGHT-substrt_x], dtype=np.float64) / np.sqrt(2)
+def get_read_noise(gain):
+    def build():
+        with astropy.io.fits.open(RNOISE_FILE) as hdul:
+            substrt_x = int(hdul[0].header["SUBSTRT1"]) - 1
+            substrt_y = int(hdul[0].header["SUBSTRT2"]) - 1
+            return (np.array(np.rot90(hdul[1].data, ROTATE)[
+                TOP-substrt_y : BOT-substrt_y,
+                LEFT-substrt_x : RIGHT-substrt_x], dtype=np.float64),)
+
+    read_noise, = load_cached(RNOISE_FILE, "read_noise", build)
+    return gain * np.asarray(read_noise) / np.sqrt(2)
 
     
 def is_power_of_two(n):
     return (n != 0) and (n & (n-1) == 0)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("filenames", nargs="+")
-parser.add_argument("--median-residuals")
-parser.add_argument("--grps-to-sat")
-args = parser.parse_args()
 
-for filename in args.filenames:
-    print("Processing", filename)
-    hdul = astropy.io.fits.open(filename)
-    assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
-    
-    #Assumptions for dark current subtraction
+def report_bad_pixels(bad_pixels):
+    for i in np.unique(bad_pixels[:,0]):
+        rows, cols = bad_pixels[bad_pixels[:,0] == i, 1:].T
+        print("These pixels are bad in integration {}: y,x={}".format(i, (rows, cols)))
+
+
+def calibrate_ramps(data, noutputs, nframes, groupgap, superbias, nonlinearity, dark, gain, block_bytes=PREPROCESS_BLOCK_BYTES):
+    #Applies superbias, ref pixel, non-linearity, 1/f, dark and gain
+    #corrections in place.  Every correction only involves one integration
+    #and group at a time, so they are all applied to a small block of
+    #integrations (or groups) while it is in cache, instead of each making a
+    #pass over the whole cube.  Gives the same result as applying
+    #subtract_superbias, subtract_ref, apply_nonlinearity, destripe,
+    #subtract_dark and multiplying by the gain in turn.
+    start = time.time()
+    steps = (["superbias"] if not SKIP_SUPERBIAS else []) + (["ref pixels"] if not SKIP_REF else []) \
+        + ["non-linearity"] + (["1/f noise"] if INSTRUMENT == "NIRSPEC" else []) + ["dark", "gain"]
+    print("Applying corrections:", ", ".join(steps))
+
+    if data.dtype not in (np.float32, np.float64):
+        data = np.array(data, dtype=FLOAT_TYPE)
+    if superbias is None and not SKIP_SUPERBIAS:
+        superbias = get_superbias(data.shape[2:])
+    if nonlinearity is None:
+        nonlinearity = get_nonlinearity()
+    if dark is None:
+        dark = get_dark(nframes, groupgap, data.shape[1])
+    coeffs, _ = nonlinearity
+    final_dark = dark[0][:data.shape[1]]
+    assert(len(final_dark) == data.shape[1])
+
+    #Blocks are whole integrations, or groups of one integration if a single
+    #integration doesn't fit
+    N_int, N_grp = data.shape[:2]
+    frame_bytes = data[0,0].size * data.itemsize
+    grps_per_block = max(1, min(N_grp, int(block_bytes // frame_bytes)))
+    ints_per_block = max(1, int(block_bytes // (frame_bytes * N_grp))) if grps_per_block == N_grp else 1
+    acc = np.empty((min(ints_per_block, N_int), grps_per_block) + data.shape[2:], dtype=data.dtype)
+
+    for i in range(0, N_int, ints_per_block):
+        for g in range(0, N_grp, grps_per_block):
+            x = data[i : i + ints_per_block, g : g + grps_per_block]
+            if not SKIP_SUPERBIAS:
+                x -= superbias
+            if not SKIP_REF:
+                subtract_ref(x, noutputs)
+
+            horner_in_place(x, coeffs, acc[:x.shape[0], :x.shape[1]])
+
+            if INSTRUMENT == "NIRSPEC":
+                #Do other instruments benefit from this? Haven't checked
+                x -= get_stripes(x)
+            x -= final_dark[g : g + grps_per_block]
+            x *= gain
+
+    print("Corrections took", time.time() - start)
+    return data
+
+
+def get_references(nframes, groupgap, frame_shape, ngroups):
+    #All the reference arrays needed to calibrate a segment
+    key = (nframes, groupgap, tuple(frame_shape), ngroups)
+    if key in shared_references:
+        return shared_references[key]
+
+    #Arrays applied to the ramps are in FLOAT_TYPE, so they don't upcast them
+    mask = get_mask()
+    superbias = None if SKIP_SUPERBIAS else np.asarray(get_superbias(tuple(frame_shape)), dtype=FLOAT_TYPE)
+    coeffs, nonlinearity_mask = get_nonlinearity()
+    coeffs = np.asarray(coeffs, dtype=FLOAT_TYPE)
+    mask |= nonlinearity_mask
+    dark, dark_mask = get_dark(nframes, groupgap, ngroups)
+    mask |= dark_mask
+    gain = get_gain()
+    shared_references[key] = {"mask": mask, "superbias": superbias,
+            "nonlinearity": (coeffs, nonlinearity_mask), "dark": (dark, dark_mask),
+            "gain": np.asarray(gain, dtype=FLOAT_TYPE), "read_noise": get_read_noise(gain)}
+    return shared_references[key]
+
+
+def share_references(references):
+    #Copies the reference arrays for each key into shared memory.  Returns
+    #the shared memory blocks, which the caller must unlink when done, and
+    #descriptions of the arrays to pass to attach_references.
+    blocks = []
+    def share(arr):
+        if arr is None:
+            return None
+        if isinstance(arr, tuple):
+            return tuple(share(a) for a in arr)
+        arr = np.cpu(arr)
+        block = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+        numpy.ndarray(arr.shape, arr.dtype, buffer=block.buf)[...] = arr
+        blocks.append(block)
+        return ("shared", block.name, arr.shape, arr.dtype.str)
+
+    descriptions = {key: {name: share(arr) for name, arr in refs.items()}
+                    for key, refs in references.items()}
+    return blocks, descriptions
+
+
+def attach_references(descriptions):
+    #Worker initializer: makes get_references return read-only views of the
+    #arrays shared by share_references
+    def attach(description):
+        if description is None:
+            return None
+        if description[0] != "shared":
+            return tuple(attach(d) for d in description)
+        _, name, shape, dtype = description
+        block = shared_memory.SharedMemory(name=name)
+        shared_blocks.append(block)
+        arr = numpy.ndarray(shape, dtype, buffer=block.buf)
+        arr.flags.writeable = False
+        return np.asarray(arr)
+
+    for key, refs in descriptions.items():
+        shared_references[key] = {name: attach(d) for name, d in refs.items()}
+
+
+def get_int_bytes(shape):
+    #Memory needed per integration calibrated at once, given that up to
+    #CUBE_COPIES cubes and FRAME_COPIES frames per integration are alive at a
+    #time
+    N_int, N_grp, N_row, N_col = shape
+    return N_row * N_col * (N_grp * np.dtype(FLOAT_TYPE).itemsize * CUBE_COPIES + 8 * FRAME_COPIES)
+
+
+def get_block_size(shape, max_memory):
+    #Number of integrations that can be calibrated at once within max_memory
+    #bytes
+    N_int = shape[0]
+    return max(1, min(N_int, int(max_memory // get_int_bytes(shape))))
+
+
+def get_segment_bytes(hdul, median_memory=None):
+    #Memory needed to calibrate a segment whole, with median_memory bytes
+    #for the median over integrations (MEDIAN_BLOCK_BYTES by default)
+    shape = tuple(hdul[1].shape[:2]) + tuple(get_frame_shape(hdul))
+    if median_memory is None:
+        median_memory = MEDIAN_BLOCK_BYTES
+    return shape[0] * get_int_bytes(shape) + median_memory
+
+
+def get_held_bytes(*arrays):
+    #Memory held by the given arrays (or dicts or tuples of them), counting
+    #each array once
+    held = {}
+    def add(arr):
+        if isinstance(arr, dict):
+            arr = tuple(arr.values())
+        if isinstance(arr, tuple):
+            for a in arr:
+                add(a)
+        elif arr is not None:
+            held[id(arr)] = arr.nbytes
+    add(arrays)
+    return sum(held.values())
+
+
+def get_dq(ramp_mask, mask, signal):
+    #DQ of the output.  mask: the reference DQ values
+    if OUTPUT_PROFILE == "compact":
+        return np.uint8(DQ_RAMP) * ramp_mask | np.uint8(DQ_REFERENCE) * (mask != 0) | np.uint8(DQ_NAN) * np.isnan(signal)
+    return ramp_mask | mask | np.isnan(signal)
+
+
+def get_rateints_hdus(hdul, sci, err, dq, read_noise, residuals1, residuals2=None):
+    #hdul: the uncal file, for its primary header and INT_TIMES.  Images
+    #given as (name, shape, dtype) are left for create_image_file to fill in.
+    def image(data, name, dtype=None):
+        return data if isinstance(data, tuple) else make_image_hdu(data, name, dtype)
+
+    hdus = [hdul[0],
+            image(sci, "SCI", OUTPUT_FLOAT_TYPE),
+            image(err, "ERR", OUTPUT_FLOAT_TYPE),
+            image(dq, "DQ"),
+            image(read_noise, "RNOISE", OUTPUT_FLOAT_TYPE),
+            image(residuals1, "RESIDUALS1", OUTPUT_FLOAT_TYPE)]
+    if residuals2 is not None:
+        hdus.append(image(residuals2, "RESIDUALS2", OUTPUT_FLOAT_TYPE))
+    hdus.append(hdul["INT_TIMES"])
+    return hdus
+
+
+def write_rateints(hdul, output_filename, sci, err, dq, read_noise, residuals1, residuals2=None):
+    output_hdul = astropy.io.fits.HDUList(get_rateints_hdus(hdul, sci, err, dq, read_noise, residuals1, residuals2))
+    output_hdul.writeto(output_filename, overwrite=True)
+    output_hdul.close()
+
+
+def create_rateints_file(hdul, output_filename, shape, dq_type, read_noise, residuals1):
+    #Writes the rateints file of a segment calibrated a block of integrations
+    #at a time, with SCI, ERR, DQ and RESIDUALS2 filled in later with
+    #write_image_block.  Compressed HDUs can't be written a block at a time,
+    #so in that case they're written to a separate file that
+    #finish_rateints_file compresses.
+    float_type = OUTPUT_FLOAT_TYPE or np.float64
+    residuals2 = None
+    if OUTPUT_PROFILE != "compact":
+        residuals2 = ("RESIDUALS2", residuals1.shape, float_type)
+    hdus = get_rateints_hdus(hdul, ("SCI", shape, float_type), ("ERR", shape, float_type), ("DQ", shape, dq_type), read_noise, residuals1, residuals2)
+    streamed_filename = output_filename + ".part" if COMPRESS_OUTPUT else output_filename
+    return create_image_file(streamed_filename, hdus)
+
+
+def finish_rateints_file(output_filename, outputs):
+    #outputs: from create_rateints_file
+    if not COMPRESS_OUTPUT:
+        return
+    streamed_filename = output_filename + ".part"
+    with astropy.io.fits.open(streamed_filename) as streamed:
+        hdus = [make_image_hdu(hdu.data, hdu.name) if hdu.name in outputs else hdu for hdu in streamed]
+        astropy.io.fits.HDUList(hdus).writeto(output_filename, overwrite=True)
+    os.remove(streamed_filename)
+
+
+def get_frame_shape(hdul):
+    #Shape of the calibrated frames, after rotation
+    return get_rotated_shape(hdul[1], ROTATE)[-2:]
+
+
+def get_saved_ramps_filenames(filename):
+    #Where --save-ramps keeps the calibrated ramps of a segment (before
+    #residual subtraction) and its RESIDUALS1
+    stem = os.path.basename(filename).replace("_uncal", "").replace(".fits", "")
+    return "ramps_{}.npy".format(stem), "residuals1_{}.npy".format(stem)
+
+
+def calibrate_streaming(hdul, output_filename, max_memory, median_residuals=None, grps_to_sat=None, saved_ramps=None, filename=None):
+    #Same calibration as the whole-cube path, but only a block of
+    #integrations is in memory at a time.  The calibrated ramps are kept in
+    #memory-mapped scratch files between the two passes, and the output
+    #images are written to the rateints file as each block finishes.
     nframes = hdul[0].header["NFRAMES"]
     groupgap = hdul[0].header["GROUPGAP"]
     assert(is_power_of_two(nframes))
 
-    data = np.array(
-        np.rot90(hdul[1].data, ROTATE, axes=(2,3)),
-        dtype=np.float64)
-    
-    N_int, N_grp, N_row, N_col = data.shape
-    mask = get_mask()
+    N_int, N_grp = hdul[1].shape[:2]
+    N_row, N_col = get_frame_shape(hdul)
+    shape = (N_int, N_grp, N_row, N_col)
+    frame_shape = (N_int, N_row, N_col)
 
-    if not SKIP_SUPERBIAS:
-        print("Subtracting superbias")
-        data = subtract_superbias(data)
+    refs = get_references(nframes, groupgap, (N_row, N_col), N_grp)
+    mask = refs["mask"]
+    read_noise = refs["read_noise"]
+    if grps_to_sat is not None:
+        grps_to_sat = np.load(grps_to_sat)
 
-    if not SKIP_REF:
-        print("Subtracting ref pixels")
-        data = subtract_ref(data, hdul[0].header["NOUTPUTS"])
+    #The blocks share the budget with the reference arrays, RESIDUALS1 and
+    #the residuals subtracted, and the weight tables of every fit, which are
+    #built now so that they're counted
+    for N in get_fit_lengths(N_grp, grps_to_sat):
+        get_weight_table(N)
+    held = get_held_bytes(refs, grps_to_sat, weight_tables) + 2 * N_grp * N_row * N_col * 8
+    block_size = get_block_size(shape, max_memory - held)
+    print("Calibrating {} integrations at a time".format(block_size))
 
-    print("Applying non-linearity correction")
-    data, dq = apply_nonlinearity(data)
-    mask |= dq
-    gc.collect()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_filename))) as scratch_dir:
+        def scratch(name, shape, dtype=np.float64):
+            return open_memmap(os.path.join(scratch_dir, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
 
-    if INSTRUMENT=="NIRSPEC":
-        #Do other instruments benefit from this? Haven't checked
-        print("Subtracting 1/f noise group by group")
-        data = destripe(data)
+        ramps = scratch("ramps", shape, FLOAT_TYPE)
+        signal1 = scratch("signal1", frame_shape)
+        signal2 = scratch("signal2", frame_shape)
 
-    print("Applying dark correction")
-    data, dark_mask = subtract_dark(data, nframes, groupgap)
-    mask |= dark_mask
+        ramps_filename, residuals1_filename = get_saved_ramps_filenames(filename)
+        if saved_ramps == "save":
+            saved = open_memmap(ramps_filename, mode="w+", dtype=FLOAT_TYPE, shape=shape)
+        elif saved_ramps == "reuse":
+            print("Reading calibrated ramps from", ramps_filename)
+            saved = numpy.load(ramps_filename, mmap_mode="r")
+            assert(saved.shape == shape)
 
-    print("Applying gain correction")
-    gain = get_gain()
-    data = data * gain
+        for start in range(0, N_int, block_size):
+            end = min(start + block_size, N_int)
+            if saved_ramps == "reuse":
+                ramps[start:end] = saved[start:end]
+                continue
+            print("Calibrating integrations {} to {}".format(start, end))
+            data = read_block(hdul[1], np.s_[start:end], rotate=ROTATE)
+            data = calibrate_ramps(data, hdul[0].header["NOUTPUTS"], nframes, groupgap, refs["superbias"], refs["nonlinearity"], refs["dark"], refs["gain"])
+            print("Getting slopes 1")
+            signal, _, _ = get_slopes_initial(data, read_noise, residuals=False)
+            ramps[start:end] = np.cpu(data)
+            signal1[start:end] = np.cpu(signal)
+            if saved_ramps == "save":
+                saved[start:end] = np.cpu(data)
+            data = signal = None
+            gc.collect()
+        saved = None
+
+        if saved_ramps == "reuse":
+            residuals1 = np.asarray(numpy.load(residuals1_filename))
+        else:
+            residuals1 = get_median_residuals(ramps, signal1, max_memory - get_held_bytes(refs, grps_to_sat, weight_tables))
+        if saved_ramps == "save":
+            numpy.save(residuals1_filename, np.cpu(residuals1))
+        if median_residuals is not None:
+            print("Subtracting median residuals")
+            subtracted = np.load(median_residuals)
+        else:
+            print("Not subtracting median residuals")
+            subtracted = residuals1
+        outputs = create_rateints_file(hdul, output_filename, frame_shape, np.uint8 if OUTPUT_PROFILE == "compact" else mask.dtype, read_noise, residuals1)
+
+        for start in range(0, N_int, block_size):
+            end = min(start + block_size, N_int)
+            data = np.array(ramps[start:end])
+            data -= subtracted
+            data[:,:,:,-1] = 0 #sometimes anomalous
+            ramps[start:end] = np.cpu(data)
+            data = None
+
+        #The fit of each pixel doesn't depend on the others, so each block
+        #is fit to the end on its own, from group differences computed once
+        print("Getting slopes 2")
+        bad_pixels = []
+        for start in range(0, N_int, block_size):
+            end = min(start + block_size, N_int)
+            data = np.asarray(ramps[start:end])
+            signal, error, per_int_mask, _, bad = get_slopes(data, read_noise, residuals=False)
+            bad[:,0] += start
+            bad_pixels.append(bad)
+            signal2[start:end] = np.cpu(signal)
+
+            if grps_to_sat is not None:
+                set_slopes_saturated(data, read_noise, signal, error, grps_to_sat)
+
+            if not SKIP_FLAT:
+                signal, error, flat_err = apply_flat(signal, error)
+
+            write_image_block(outputs["SCI"], start, signal)
+            write_image_block(outputs["ERR"], start, error)
+            write_image_block(outputs["DQ"], start, get_dq(per_int_mask, mask, signal))
+            data = signal = error = per_int_mask = flat_err = None
+            gc.collect()
+        report_bad_pixels(np.concatenate(bad_pixels))
+
+        if OUTPUT_PROFILE != "compact":
+            residuals2 = get_median_residuals(ramps, signal2, max_memory - get_held_bytes(refs, grps_to_sat, weight_tables, residuals1, subtracted))
+            write_image_block(outputs["RESIDUALS2"], 0, residuals2)
+        finish_rateints_file(output_filename, outputs)
+        ramps = signal1 = signal2 = None
+
+def get_references_key(hdul):
+    #Key of the reference arrays a segment needs, for get_references
+    return (hdul[0].header["NFRAMES"], hdul[0].header["GROUPGAP"], get_frame_shape(hdul), hdul[1].shape[1])
+
+
+def get_rateints_filename(filename):
+    return "rateints_" + os.path.basename(filename).replace("_uncal", "")
+
+
+def get_calibrated_ramps(hdul, saved_ramps=None, filename=None, median_memory=None):
+    #Calibrated ramps of a segment (before residual subtraction), its
+    #RESIDUALS1 and its reference arrays.  median_memory: bytes for the
+    #median over integrations, MEDIAN_BLOCK_BYTES by default
+    nframes, groupgap, frame_shape, N_grp = get_references_key(hdul)
+    #Assumptions for dark current subtraction
+    assert(is_power_of_two(nframes))
+    refs = get_references(nframes, groupgap, frame_shape, N_grp)
+
+    if saved_ramps is not None:
+        ramps_filename, residuals1_filename = get_saved_ramps_filenames(filename)
+    if saved_ramps == "reuse":
+        print("Reading calibrated ramps from", ramps_filename)
+        data = np.array(numpy.load(ramps_filename, mmap_mode="r"), dtype=FLOAT_TYPE)
+        assert(data.shape == (hdul[1].shape[0], N_grp) + tuple(frame_shape))
+        residuals1 = np.asarray(numpy.load(residuals1_filename))
+        return data, residuals1, refs
+
+    data = read_block(hdul[1], rotate=ROTATE)
+    data = calibrate_ramps(data, hdul[0].header["NOUTPUTS"], nframes, groupgap, refs["superbias"], refs["nonlinearity"], refs["dark"], refs["gain"])
 
-    read_noise = get_read_noise(gain)
     print("Getting slopes 1")
 
     #original_data = np.copy(data)
     #data = data[:,0:-1]
-    signal, error, residuals1 = get_slopes_initial(data, read_noise)
-    if args.median_residuals is not None:
-        data -= np.load(args.median_residuals)
+    signal, error, residuals1 = get_slopes_initial(data, refs["read_noise"], median_memory=median_memory)
+    if saved_ramps == "save":
+        numpy.save(ramps_filename, np.cpu(data))
+        numpy.save(residuals1_filename, np.cpu(residuals1))
+    return data, residuals1, refs
+
+
+def calibrate_segment(hdul, median_residuals=None, grps_to_sat=None, saved_ramps=None, filename=None, median_memory=None):
+    #Calibrates a whole segment in memory.  median_residuals and grps_to_sat
+    #are arrays.  Returns what write_rateints writes: sci, err, dq,
+    #read_noise, residuals1 and residuals2.
+    data, residuals1, refs = get_calibrated_ramps(hdul, saved_ramps, filename, median_memory)
+    read_noise = refs["read_noise"]
+
+    if median_residuals is not None:
+        data -= median_residuals
         print("Subtracting median residuals")
     else:
         print("Not subtracting median residuals")
@@ -349,24 +1073,111 @@ for filename in args.filenames:
 
     print("Getting slopes 2")
     data[:,:,:,-1] = 0 #sometimes anomalous
-    signal, error, per_int_mask, residuals2 = get_slopes(data, read_noise)
+    signal, error, per_int_mask, residuals2, bad_pixels = get_slopes(data, read_noise, residuals=OUTPUT_PROFILE != "compact", median_memory=median_memory)
+    report_bad_pixels(bad_pixels)
+
+    if grps_to_sat is not None:
+        set_slopes_saturated(data, read_noise, signal, error, grps_to_sat)
 
-    if args.grps_to_sat is not None:
-        set_slopes_saturated(data, signal, args.grps_to_sat)
-    
     if not SKIP_FLAT:
         print("Applying flat")
         signal, error, flat_err = apply_flat(signal, error)
-        
-    per_int_mask = per_int_mask | mask
-    per_int_mask = per_int_mask | np.isnan(signal)
-    sci_hdu = astropy.io.fits.ImageHDU(np.cpu(signal), name="SCI")
-    err_hdu = astropy.io.fits.ImageHDU(np.cpu(error), name="ERR")
-    dq_hdu = astropy.io.fits.ImageHDU(np.cpu(per_int_mask), name="DQ")
-    res1_hdu = astropy.io.fits.ImageHDU(np.cpu(residuals1), name="RESIDUALS1")
-    res2_hdu = astropy.io.fits.ImageHDU(np.cpu(residuals2), name="RESIDUALS2")
-    read_noise_hdu = astropy.io.fits.ImageHDU(np.cpu(read_noise), name="RNOISE")
-    output_hdul = astropy.io.fits.HDUList([hdul[0], sci_hdu, err_hdu, dq_hdu, read_noise_hdu, res1_hdu, res2_hdu, hdul["INT_TIMES"]])
-    output_hdul.writeto("rateints_" + os.path.basename(filename).replace("_uncal", ""), overwrite=True)
-    output_hdul.close()
+
+    return signal, error, get_dq(per_int_mask, refs["mask"], signal), read_noise, residuals1, residuals2
+
+
+def calibrate_file(filename, median_residuals=None, grps_to_sat=None, max_memory=None, saved_ramps=None, median_memory=None):
+    #max_memory: budget in bytes.  If given and the segment doesn't fit in
+    #it whole, it's calibrated in blocks of integrations that do.
+    #saved_ramps: "save" to save the calibrated ramps and RESIDUALS1 for a
+    #later run, "reuse" to start from them instead of the uncal file.
+    #median_memory: bytes for the median over integrations of a segment
+    #calibrated whole
+    print("Processing", filename)
+    hdul = astropy.io.fits.open(filename)
+    assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
+    output_filename = get_rateints_filename(filename)
+
+    if max_memory is not None and max_memory < get_segment_bytes(hdul, median_memory):
+        calibrate_streaming(hdul, output_filename, max_memory, median_residuals, grps_to_sat, saved_ramps, filename)
+        hdul.close()
+        return
+
+    if median_residuals is not None:
+        median_residuals = np.load(median_residuals)
+    if grps_to_sat is not None:
+        grps_to_sat = np.load(grps_to_sat)
+    write_rateints(hdul, output_filename, *calibrate_segment(hdul, median_residuals, grps_to_sat, saved_ramps, filename, median_memory))
     hdul.close()
+
+
+def calibrate_parallel(filenames, workers, max_memory=None, median_residuals=None, grps_to_sat=None, saved_ramps=None, median_memory=None):
+    #Calibrates up to workers segments at once.  The reference arrays are
+    #loaded once here and shared with the workers.  If max_memory (bytes) is
+    #given, each segment is allotted the memory it needs to be calibrated
+    #whole, up to max_memory, and segments are only started while the
+    #allotments of the running ones fit within max_memory.
+    references = {}
+    needed = {}
+    for filename in filenames:
+        with astropy.io.fits.open(filename) as hdul:
+            key = get_references_key(hdul)
+            needed[filename] = get_segment_bytes(hdul, median_memory)
+        if key not in references:
+            references[key] = get_references(*key)
+
+    blocks, descriptions = share_references(references)
+    references = None
+    try:
+        with ProcessPoolExecutor(workers, initializer=attach_references, initargs=(descriptions,)) as pool:
+            pending = list(filenames)
+            running = {}
+            while pending or running:
+                for filename in list(pending):
+                    if len(running) == workers:
+                        break
+                    if max_memory is None:
+                        allotment = None
+                    else:
+                        allotment = min(needed[filename], max_memory)
+                        if sum(running.values()) + allotment > max_memory:
+                            continue
+                    future = pool.submit(calibrate_file, filename, median_residuals, grps_to_sat, allotment, saved_ramps, median_memory)
+                    running[future] = 0 if allotment is None else allotment
+                    pending.remove(filename)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    del running[future]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filenames", nargs="+")
+    parser.add_argument("--median-residuals")
+    parser.add_argument("--grps-to-sat")
+    parser.add_argument("--max-memory", type=float, help="Memory budget in GB.  If given, segments are calibrated in blocks of integrations that fit within it")
+    parser.add_argument("--workers", type=int, default=1, help="Number of segments to calibrate in parallel.  With --max-memory, the budget is shared by all the segments running at once")
+    parser.add_argument("--median-memory", type=float, help="Memory in GB for the median over integrations of a segment calibrated whole, %g by default.  With --max-memory, the median uses whatever the budget leaves" % (MEDIAN_BLOCK_BYTES / 1e9))
+    ramps_group = parser.add_mutually_exclusive_group()
+    ramps_group.add_argument("--save-ramps", dest="saved_ramps", action="store_const", const="save", help="Save the calibrated ramps (in FLOAT_TYPE) and RESIDUALS1 of each segment to the current directory, for a later --reuse-ramps run")
+    ramps_group.add_argument("--reuse-ramps", dest="saved_ramps", action="store_const", const="reuse", help="Start from the ramps saved by --save-ramps, skipping the ramp calibration and first slope fit")
+    args = parser.parse_args()
+    max_memory = None if args.max_memory is None else args.max_memory * 1e9
+    median_memory = None if args.median_memory is None else args.median_memory * 1e9
+
+    if args.workers > 1:
+        calibrate_parallel(args.filenames, args.workers, max_memory, args.median_residuals, args.grps_to_sat, args.saved_ramps, median_memory)
+        return
+
+    for filename in args.filenames:
+        calibrate_file(filename, args.median_residuals, args.grps_to_sat, max_memory, args.saved_ramps, median_memory)
+
+
+if __name__ == "__main__":
+    main()
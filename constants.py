@@ -1,6 +1,14 @@
 import os
 
 USE_GPU = False
+#Set to "float32" to calibrate, remove the background and extract in single
+#precision, which halves memory use.  Sums are still accumulated in float64.
+FLOAT_TYPE = "float64"
+#Set to "compact" to write rateints and cleaned files with float32 images,
+#DQ as uint8 bit flags and no RESIDUALS2.  COMPRESS_OUTPUT tile-compresses
+#them as well, losslessly.
+OUTPUT_PROFILE = "full"
+COMPRESS_OUTPUT = False
 REF_DIR = os.path.expanduser("~/jwst_refs/")
 RIGHT_MARGIN_BKD = 5
 HIGH_ERROR = 1e10
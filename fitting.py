@@ -60,3 +60,37 @@ def robust_polyfit(xs, ys, deg, target_xs=None, include_residuals=False, inverse
         return result, residuals
     return result
 
+
+
+def interp_masked(data, mask, fill_value=np.nan):
+    #Replaces the masked values of every row (the last axis) of data by
+    #linear interpolation between the nearest unmasked values, as np.interp
+    #would, including holding the end values constant.  All rows are done at
+    #once, and only the masked values are visited.  Rows that are entirely
+    #masked are set to fill_value.  Returns a new float64 array.
+    result = np.array(data, dtype=np.float64)
+    flat = result.reshape(-1)
+    N = result.shape[-1]
+    bad = np.flatnonzero(mask)
+    good = np.flatnonzero(~np.asarray(mask))
+    if len(bad) == 0:
+        return result
+    if len(good) == 0:
+        flat[:] = fill_value
+        return result
+
+    #Nearest good values on either side, if they're in the same row
+    j = np.searchsorted(good, bad)
+    prev = good[np.maximum(j - 1, 0)]
+    next = good[np.minimum(j, len(good) - 1)]
+    rows = bad // N
+    has_prev = (j > 0) & (prev // N == rows)
+    has_next = (j < len(good)) & (next // N == rows)
+
+    values = np.where(has_prev, flat[prev], flat[next])
+    both = has_prev & has_next
+    slope = (flat[next[both]] - flat[prev[both]]) / (next[both] - prev[both])
+    values[both] = slope * (bad[both] - prev[both]) + flat[prev[both]]
+    values[~(has_prev | has_next)] = fill_value
+    flat[bad] = values
+    return result
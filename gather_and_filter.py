@@ -106,52 +106,58 @@ def clean_pixels(data, filter_width=21, sigma=5):
         data[:,c] = np.interp(rows, rows[~outliers], lc[~outliers])
     return data
 
-data, errors, bkd, times, wavelengths, section_edges = read_data(sys.argv[1:])
-
-output = {"uncut_wavelengths": wavelengths,
-          "uncut_times": times,
-          "uncut_data": data,
-          "uncut_errors": errors,
-          "uncut_bkd": bkd,
-          "uncut_section_edges": section_edges
-}
-
-print(wavelengths[244:250])
-print(wavelengths[250:])
-plt.figure()
-plt.imshow(data / np.mean(data, axis=0), aspect='auto', vmin=0.98, vmax=1.01)
-for e in section_edges:
-    plt.axhline(e, color='k')
- 
-plt.xlabel("Wavelength")
-plt.ylabel("Time")
-
-y, x, A = np.loadtxt("positions.txt", usecols=(2,3,4), unpack=True)
-output.update({"uncut_y": y,
-               "uncut_x": x})
-
-
-data, errors, bkd, times, x, y, bad_rows = reject_rows(data, errors, bkd, times, x, y)
-#data, errors, wavelengths = reject_cols(data, errors, wavelengths)
-#data = repair_rows(data)
-clean_pixels(data)
-
-output.update({"wavelengths": wavelengths,
-               "times": times,
-               "data": data,
-               "errors": errors,
-               "bkd": bkd,
-               "x": x,
-               "y": y,
-               "bad_rows": bad_rows
-               })
-
-with open("data.pkl", "wb") as f:
-    pickle.dump(output, f)
-
-
-plt.figure()
-plt.imshow(data / np.mean(data, axis=0), aspect='auto', vmin=0.98, vmax=1.01)
-plt.xlabel("Wavelength")
-plt.ylabel("Time")
-plt.show()
+def gather(data, errors, bkd, times, wavelengths, section_edges, y, x):
+    #Filters the spectra of every integration (N_int x N_wavelength) and
+    #positions.  Returns what goes in data.pkl.
+    output = {"uncut_wavelengths": wavelengths,
+              "uncut_times": times,
+              "uncut_data": data,
+              "uncut_errors": errors,
+              "uncut_bkd": bkd,
+              "uncut_section_edges": section_edges
+    }
+
+    print(wavelengths[244:250])
+    print(wavelengths[250:])
+    plt.figure()
+    plt.imshow(data / np.mean(data, axis=0), aspect='auto', vmin=0.98, vmax=1.01)
+    for e in section_edges:
+        plt.axhline(e, color='k')
+     
+    plt.xlabel("Wavelength")
+    plt.ylabel("Time")
+
+    output.update({"uncut_y": y,
+                   "uncut_x": x})
+
+
+    data, errors, bkd, times, x, y, bad_rows = reject_rows(data, errors, bkd, times, x, y)
+    #data, errors, wavelengths = reject_cols(data, errors, wavelengths)
+    #data = repair_rows(data)
+    clean_pixels(data)
+
+    output.update({"wavelengths": wavelengths,
+                   "times": times,
+                   "data": data,
+                   "errors": errors,
+                   "bkd": bkd,
+                   "x": x,
+                   "y": y,
+                   "bad_rows": bad_rows
+                   })
+
+    plt.figure()
+    plt.imshow(data / np.mean(data, axis=0), aspect='auto', vmin=0.98, vmax=1.01)
+    plt.xlabel("Wavelength")
+    plt.ylabel("Time")
+    return output
+
+if __name__ == "__main__":
+    data, errors, bkd, times, wavelengths, section_edges = read_data(sys.argv[1:])
+    y, x, A = np.loadtxt("positions.txt", usecols=(2,3,4), unpack=True)
+    output = gather(data, errors, bkd, times, wavelengths, section_edges, y, x)
+
+    with open("data.pkl", "wb") as f:
+        pickle.dump(output, f)
+
+    plt.show()
@@ -3,11 +3,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 import astropy.io.fits
 from constants import SAT_LEVEL, ROTATE
+from lazy_fits import read_block
 
 medians = []
 for filename in sys.argv[1:]:
     with astropy.io.fits.open(filename) as hdul:
-        median = np.median(np.rot90(hdul[1].data, ROTATE, (-2,-1)), axis=0)
+        #One group at a time, so the whole segment is never in memory
+        median = [np.median(read_block(hdul[1], grps=np.s_[g:g+1], rotate=ROTATE)[:,0], axis=0)
+                  for g in range(hdul[1].shape[1])]
         medians.append(median)
 
 image = np.mean(medians, axis=0)
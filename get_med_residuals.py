@@ -1,15 +1,94 @@
 import sys
+import argparse
 import numpy as np
 import astropy.io.fits
 
-all_residuals = []
-
-for filename in sys.argv[1:]:
-    with astropy.io.fits.open(filename) as hdul:
-        print(filename, hdul["RESIDUALS1"].data.shape)
-        all_residuals.append(hdul["RESIDUALS1"].data)
-    #print(filename)
-    
-all_residuals = np.array(all_residuals)    
-mean = np.mean(all_residuals, axis=0)
-np.save("median_residuals.npy", mean)
+#Combines the RESIDUALS1 of every segment, reading one segment at a time so
+#that memory use doesn't grow with the number of segments
+
+#Number of segments kept whole by the approximate median, at least 5
+EXACT_SEGMENTS = 11
+
+def update_mean(state, residuals):
+    #state: (sum, count)
+    if state is None:
+        return np.array(residuals, dtype=np.float64), 1
+    total, count = state
+    total += residuals
+    return total, count + 1
+
+
+def update_median(state, residuals):
+    #Approximate running median of every element with the P-squared
+    #algorithm (Jain & Chlamtac 1985), which keeps 5 markers per element.
+    #state: (heights, positions, count).  The first EXACT_SEGMENTS segments
+    #are kept, and their median is exact; the markers then start at their
+    #quartiles.
+    residuals = np.asarray(residuals, dtype=np.float64)
+    if state is None:
+        return residuals[np.newaxis], None, 1
+    q, n, count = state
+    count += 1
+    if count <= EXACT_SEGMENTS:
+        q = np.concatenate((q, residuals[np.newaxis]))
+        if count == EXACT_SEGMENTS:
+            q.sort(axis=0)
+            ranks = np.rint(np.arange(5) * (count - 1) / 4).astype(np.int64)
+            q = q[ranks]
+            n = np.ones(q.shape, dtype=np.int64) * (ranks + 1).reshape((5,) + (1,) * residuals.ndim)
+        return q, n, count
+
+    #Markers above the new value move up by one
+    q[0] = np.minimum(q[0], residuals)
+    q[4] = np.maximum(q[4], residuals)
+    for i in range(1, 5):
+        n[i] += residuals < q[i]
+    n[4] = count
+
+    #Desired marker positions for the median
+    desired = np.array([1, (count - 1) / 4 + 1, (count - 1) / 2 + 1, 3 * (count - 1) / 4 + 1, count])
+    for i in range(1, 4):
+        d = desired[i] - n[i]
+        move = ((d >= 1) & (n[i+1] - n[i] > 1)) | ((d <= -1) & (n[i-1] - n[i] < -1))
+        d = np.sign(d).astype(np.int64) * move
+        #Piecewise-parabolic prediction, or linear if it's out of order
+        parabolic = q[i] + d / (n[i+1] - n[i-1]) * (
+            (n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i])
+            + (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+        neighbour = np.where(d > 0, i + 1, i - 1)
+        q_neighbour = np.take_along_axis(q, neighbour[np.newaxis], axis=0)[0]
+        n_neighbour = np.take_along_axis(n, neighbour[np.newaxis], axis=0)[0]
+        linear = q[i] + d * (q_neighbour - q[i]) / (n_neighbour - n[i])
+        ordered = (q[i-1] < parabolic) & (parabolic < q[i+1])
+        q[i] = np.where(move, np.where(ordered, parabolic, linear), q[i])
+        n[i] += d
+    return q, n, count
+
+
+def get_result(statistic, state):
+    if statistic == "mean":
+        total, count = state
+        return total / count
+    q, n, count = state
+    if count < EXACT_SEGMENTS:
+        return np.median(q, axis=0)
+    return q[2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filenames", nargs="+")
+    parser.add_argument("--median", action="store_true", help="Take the approximate median over segments instead of the mean")
+    parser.add_argument("-o", "--output", default="median_residuals.npy")
+    args = parser.parse_args()
+
+    statistic = "median" if args.median else "mean"
+    update = update_median if args.median else update_mean
+    state = None
+    for filename in args.filenames:
+        with astropy.io.fits.open(filename) as hdul:
+            print(filename, hdul["RESIDUALS1"].shape)
+            state = update(state, hdul["RESIDUALS1"].data)
+
+    print("Saving the {} of the residuals to {}".format(statistic, args.output))
+    np.save(args.output, get_result(statistic, state))
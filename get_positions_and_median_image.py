@@ -8,77 +8,74 @@ import scipy.optimize
 from multiprocessing import Pool
 from scipy.interpolate import RectBivariateSpline
 from constants import TOP_MARGIN, Y_CENTER, INSTRUMENT, FILTER, SUBARRAY
+from fitting import interp_masked
 
 def fix_outliers(data, badpix, sigma=5):
-    for r in range(TOP_MARGIN, data.shape[0]):
-        cols = np.arange(data.shape[1])
-        good = ~badpix[r]
-        data[r] = np.interp(cols, cols[good], data[r][good])
-
-        good = ~astropy.stats.sigma_clip(data[r], sigma).mask
-        data[r] = np.interp(cols, cols[good], data[r][good])
+    #Interpolates over bad pixels, then over outliers, along every row at
+    #once.  Rows with no good pixels become NaN.
+    data[TOP_MARGIN:] = interp_masked(data[TOP_MARGIN:], badpix[TOP_MARGIN:])
+    outliers = astropy.stats.sigma_clip(data[TOP_MARGIN:], sigma, axis=1).mask
+    data[TOP_MARGIN:] = interp_masked(data[TOP_MARGIN:], outliers)
+
+def get_interpolator(template):
+    #Spline of the template, built once and shared by every chi_sqr call
+    ys = np.arange(template.shape[0])
+    xs = np.arange(template.shape[1])
+    return RectBivariateSpline(ys, xs, template)
 
 #Could try left=31, right=463 for PRISM
-def chi_sqr(params, image, error, template, left=10, right=-10, top=Y_CENTER-10, bottom=Y_CENTER+10, plot=False):
+def chi_sqr(params, image, error, interpolator, left=10, right=-10, top=Y_CENTER-10, bottom=Y_CENTER+10, plot=False):
+    #The shifted template is only evaluated in the scored window, which gives
+    #the same values there as evaluating it on the whole frame
     delta_y, delta_x, A = params
-    ys = np.arange(image.shape[0])
-    xs = np.arange(image.shape[1])
-    interpolator = RectBivariateSpline(ys, xs, template)
+    ys = np.arange(image.shape[0])[top:bottom]
+    xs = np.arange(image.shape[1])[left:right]
     shifted_template = A * interpolator(ys + delta_y, xs + delta_x)
-    residuals = image - shifted_template
-    zs = residuals / error
+    residuals = image[top:bottom, left:right] - shifted_template
+    zs = residuals / error[top:bottom, left:right]
         
     if plot:
         plt.imshow(zs)
         plt.show()
 
-    return np.sum(zs[top:bottom, left:right]**2)
+    return np.sum(zs**2)
 
     
-#chi_sqr([0.1, 20], data[0], template)
-
-all_data = []
-all_error = []
-all_filenames = []
-all_int_nums = []
-all_y = []
-all_x = []
-all_A = []
-all_badpix = None
-
-for filename in sys.argv[1:]:
+#chi_sqr([0.1, 20], data[0], get_interpolator(template))
+
+def fix_segment(data, dq):
+    #Interpolates over the bad pixels and outliers of every integration, in
+    #place
+    for i in range(len(data)):
+        fix_outliers(data[i], (dq[i] > 0) | np.isnan(data[i]))
+
+
+def read_segment(filename):
+    #SCI, with outliers fixed, and ERR of a cleaned file
     with astropy.io.fits.open(filename) as hdul:
         print(filename)
         assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
         data = hdul["SCI"].data
         error = hdul["ERR"].data
-        dq = hdul["DQ"].data
-
-        for i in range(len(data)):
-            fix_outliers(data[i], (dq[i] > 0) | np.isnan(data[i]))
-            
-        if all_data is None:
-            all_data = data
-            all_error = error
-        else:
-            all_data += list(data)
-            all_error += list(error)
-            
-        all_filenames += len(data) * [filename]
-        all_int_nums += list(np.arange(data.shape[0]))
+        fix_segment(data, hdul["DQ"].data)
+        return data, error
+
+
+def get_template(all_data):
+    template = np.median(all_data, axis=0)
+    fix_outliers(template, np.isnan(template))
+    return template
+
+
+def set_inputs(data, error, interpolator, filenames, int_nums):
+    #Pool initializer: the inputs of do_one
+    global all_data, all_error, template_interpolator, all_filenames, all_int_nums
+    all_data, all_error, template_interpolator, all_filenames, all_int_nums = data, error, interpolator, filenames, int_nums
 
-all_data = np.array(all_data)        
-all_error = np.array(all_error)
-all_error[np.isnan(all_error)] = np.inf
-print(len(all_data), len(all_filenames), len(all_int_nums))
-template = np.median(all_data, axis=0)
-fix_outliers(template, np.isnan(template))
-np.save("median_image.npy", template)
-#pdb.set_trace()
 
 def do_one(i):
     bounds = ((-0.4,0.4), (-0.2,0.2), (0.9, 1.1))
-    result = scipy.optimize.minimize(chi_sqr, [0,0,1], args=(all_data[i], all_error[i], template), bounds=bounds, method="Nelder-Mead")
+    result = scipy.optimize.minimize(chi_sqr, [0,0,1], args=(all_data[i], all_error[i], template_interpolator), bounds=bounds, method="Nelder-Mead")
 
     hit_bounds = False
     for b_ind, b in enumerate(bounds):
@@ -95,19 +92,50 @@ def do_one(i):
     if not result.success or hit_bounds:
         result.x *= np.nan
 
-    #chi_sqr(result.x, all_data[i], all_error[i], template, plot=True)
+    #chi_sqr(result.x, all_data[i], all_error[i], template_interpolator, plot=True)
     return result.x
 
-#do_one(1000)
 
-with Pool() as p:
-    results = p.map(do_one, range(len(all_data)))    
+def get_positions(data, error, template, filenames, int_nums):
+    #y, x and A of every integration, N_int x 3.  filenames and int_nums
+    #label the integrations in messages.
+    error = np.array(error)
+    error[np.isnan(error)] = np.inf
+    with Pool(initializer=set_inputs, initargs=(data, error, get_interpolator(template), filenames, int_nums)) as p:
+        return np.array(p.map(do_one, range(len(data))))
+
+
+def write_positions(output_filename, filenames, int_nums, results):
+    f = open(output_filename, "w")
+    f.write("#Filename Integration y x A\n")
+    for i in range(len(results)):
+        f.write("{} {} {} {} {}\n".format(filenames[i], int_nums[i], results[i][0], results[i][1], results[i][2]))
+    f.close()
+
+
+if __name__ == "__main__":
+    all_data = []
+    all_error = []
+    all_filenames = []
+    all_int_nums = []
+
+    for filename in sys.argv[1:]:
+        data, error = read_segment(filename)
+        all_data += list(data)
+        all_error += list(error)
+        all_filenames += len(data) * [filename]
+        all_int_nums += list(np.arange(data.shape[0]))
+
+    all_data = np.array(all_data)
+    print(len(all_data), len(all_filenames), len(all_int_nums))
+    template = get_template(all_data)
+    np.save("median_image.npy", template)
+    #pdb.set_trace()
+
+    #do_one(1000)
 
-f = open("positions.txt", "w")
-f.write("#Filename Integration y x A\n")
-for i in range(len(all_data)):
-    f.write("{} {} {} {} {}\n".format(all_filenames[i], all_int_nums[i], results[i][0], results[i][1], results[i][2]))
-f.close()
+    results = get_positions(all_data, all_error, template, all_filenames, all_int_nums)
+    write_positions("positions.txt", all_filenames, all_int_nums, results)
 
-#plt.imshow(template)
-#plt.show()
+    #plt.imshow(template)
+    #plt.show()
@@ -0,0 +1,163 @@
+import os
+import io
+import astropy.io.fits
+import numpy
+import _cupy_numpy as np
+from constants import FLOAT_TYPE, OUTPUT_PROFILE, COMPRESS_OUTPUT
+
+#Type of the floating point images written to products, or None to keep the
+#type they were calculated in
+OUTPUT_FLOAT_TYPE = numpy.float32 if OUTPUT_PROFILE == "compact" else None
+
+#Lazy reads of uncal (N_int x N_grp x N_row x N_col) and rateints
+#(N_int x N_row x N_col) products.  Only the requested integrations, groups
+#and rows are read from disk and scaled, through HDU.section, which works on
+#files opened with the default astropy.io.fits.open (memory-mapped where the
+#data isn't scaled).  Rows are in rotated coordinates.  Arrays can be given
+#in place of HDUs, and dicts of arrays in place of HDULists, for products
+#held in memory.
+
+def get_section(hdu):
+    return getattr(hdu, "section", hdu)
+
+
+def get_rotated_shape(hdu, rotate=0):
+    shape = tuple(hdu.shape)
+    if rotate % 2 != 0:
+        shape = shape[:-2] + (shape[-1], shape[-2])
+    return shape
+
+
+def get_raw_window(shape, rows, cols, rotate=0):
+    #Slices of the unrotated N_row x N_col frame that hold the given rows and
+    #columns of the frame rotated by rotate * 90 degrees
+    N_row, N_col = shape
+    rotate %= 4
+    rotated_shape = (N_col, N_row) if rotate % 2 != 0 else (N_row, N_col)
+    r0, r1, row_step = rows.indices(rotated_shape[0])
+    c0, c1, col_step = cols.indices(rotated_shape[1])
+    assert(row_step == 1 and col_step == 1)
+    if rotate == 0:
+        return slice(r0, r1), slice(c0, c1)
+    if rotate == 1:
+        return slice(c0, c1), slice(N_col - r1, N_col - r0)
+    if rotate == 2:
+        return slice(N_row - r1, N_row - r0), slice(N_col - c1, N_col - c0)
+    return slice(N_row - c1, N_row - c0), slice(r0, r1)
+
+
+def read_block(hdu, ints=slice(None), grps=slice(None), rows=slice(None), cols=slice(None), rotate=0, dtype=FLOAT_TYPE, block_ints=8):
+    #Returns hdu[ints, grps, rows, cols] (no grps for rateints), rotated by
+    #rotate * 90 degrees, as a new array.  Integrations are read and rotated
+    #block_ints at a time, so the raw data is never copied whole.
+    shape = get_rotated_shape(hdu, rotate)
+    raw_rows, raw_cols = get_raw_window(hdu.shape[-2:], rows, cols, rotate)
+    int_start, int_stop, step = ints.indices(shape[0])
+    assert(step == 1)
+    if len(shape) == 3:
+        leading = ()
+    else:
+        leading = (grps,)
+        shape = shape[:1] + (len(range(*grps.indices(shape[1]))),) + shape[2:]
+    shape = (int_stop - int_start,) + shape[1:-2] + (
+        len(range(*rows.indices(shape[-2]))), len(range(*cols.indices(shape[-1]))))
+
+    result = np.empty(shape, dtype=dtype)
+    for i in range(int_start, int_stop, block_ints):
+        end = min(i + block_ints, int_stop)
+        block = get_section(hdu)[(slice(i, end),) + leading + (raw_rows, raw_cols)]
+        result[i - int_start : end - int_start] = np.asarray(numpy.rot90(block, rotate, axes=(-2,-1)))
+    return result
+
+
+def read_bkd(hdul, ints=slice(None), rows=slice(None), cols=slice(None), dtype=FLOAT_TYPE):
+    #BKD and BKD_ERR of a cleaned file, as N_int x N_row x N_col images,
+    #whether remove_bkd.py stored them as images or, with --column-bkd, as
+    #one row per integration plus, for NIRCAM, one column per integration
+    if len(hdul["BKD"].shape) == 3:
+        return (read_block(hdul["BKD"], ints, rows=rows, cols=cols, dtype=dtype),
+                read_block(hdul["BKD_ERR"], ints, rows=rows, cols=cols, dtype=dtype))
+    bkd = np.asarray(get_section(hdul["BKD"])[ints, cols], dtype=dtype)[:,np.newaxis,:]
+    var = np.asarray(get_section(hdul["BKD_ERR"])[ints, cols], dtype=dtype)[:,np.newaxis,:]**2
+    if "BKD_ROWS" in hdul:
+        bkd = bkd + np.asarray(get_section(hdul["BKD_ROWS"])[ints, rows], dtype=dtype)[:,:,np.newaxis]
+        var = var + np.asarray(get_section(hdul["BKD_ROWS_ERR"])[ints, rows], dtype=dtype)[:,:,np.newaxis]**2
+    else:
+        num_rows = len(range(*rows.indices(hdul["SCI"].shape[1])))
+        bkd = np.repeat(bkd, num_rows, axis=1)
+        var = np.repeat(var, num_rows, axis=1)
+    return bkd, np.sqrt(var)
+
+
+def append_image(filename, name, shape, dtype):
+    #Appends the header of an image HDU of the given shape and dtype to
+    #filename, and room for its data, which is filled in later with
+    #write_image_block.  Returns the image, to pass to write_image_block.
+    dtype = numpy.dtype(dtype)
+    header = astropy.io.fits.ImageHDU(numpy.zeros((1,) * len(shape), dtype=dtype), name=name).header
+    for i, n in enumerate(shape[::-1]):
+        header["NAXIS{}".format(i + 1)] = n
+
+    with open(filename, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        f.write(header.tostring().encode("ascii"))
+        #Unsigned integers are stored signed, offset by BZERO
+        kind = "i" if dtype.kind == "u" and dtype.itemsize > 1 else dtype.kind
+        offset = f.tell()
+        size = int(numpy.prod(shape)) * dtype.itemsize
+        f.truncate(offset + -(-size // 2880) * 2880)
+    return (filename, offset, tuple(shape), ">{}{}".format(kind, dtype.itemsize), int(header.get("BZERO", 0)))
+
+
+def append_hdus(filename, hdus):
+    #Appends extension HDUs to filename.  They're written out through an
+    #HDUList, as a whole file would be, so that they're left as they were.
+    primary = astropy.io.fits.PrimaryHDU()
+    buffer = io.BytesIO()
+    astropy.io.fits.HDUList([primary] + hdus).writeto(buffer)
+    with open(filename, "ab") as f:
+        f.write(buffer.getvalue()[len(primary.header.tostring()):])
+
+
+def create_image_file(filename, hdus):
+    #Writes hdus to filename, in order.  Any (name, shape, dtype) among them
+    #after the primary HDU stands for an image HDU whose data is filled in
+    #later with write_image_block, so that it never has to be in memory
+    #whole.  Returns those images by name, to pass to write_image_block.
+    astropy.io.fits.HDUList(hdus[:1]).writeto(filename, overwrite=True)
+    result = {}
+    pending = []
+    for hdu in hdus[1:]:
+        if not isinstance(hdu, tuple):
+            pending.append(hdu)
+            continue
+        if pending:
+            append_hdus(filename, pending)
+            pending = []
+        result[hdu[0]] = append_image(filename, *hdu)
+    if pending:
+        append_hdus(filename, pending)
+    return result
+
+
+def write_image_block(image, start, values):
+    #Writes values to the integrations of an image from create_image_file
+    #starting at start
+    filename, offset, shape, storage, bzero = image
+    values = np.cpu(values)
+    if bzero != 0:
+        values = numpy.asarray(values, dtype=numpy.int64) - bzero
+    data = numpy.memmap(filename, dtype=storage, mode="r+", offset=offset, shape=shape)
+    data[start : start + len(values)] = values
+    data.flush()
+
+
+def make_image_hdu(data, name, dtype=None):
+    #Image HDU for a product, tile-compressed if COMPRESS_OUTPUT.  Floats
+    #aren't quantized, so the compression is lossless.
+    data = numpy.asarray(np.cpu(data), dtype=dtype)
+    if not COMPRESS_OUTPUT:
+        return astropy.io.fits.ImageHDU(data, name=name)
+    if data.dtype == bool:
+        data = data.astype(numpy.uint8)
+    return astropy.io.fits.CompImageHDU(data, name=name, compression_type="GZIP_2", quantize_level=0.0)
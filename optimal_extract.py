@@ -7,9 +7,11 @@ import scipy.linalg
 import os.path
 import astropy.stats
 import pdb
-from constants import HIGH_ERROR, TOP_MARGIN, X_MIN, X_MAX, OPT_EXTRACT_WINDOW, BKD_REG_TOP, BKD_REG_BOT, Y_CENTER, INSTRUMENT, FILTER, SUBARRAY
+from constants import HIGH_ERROR, TOP_MARGIN, X_MIN, X_MAX, OPT_EXTRACT_WINDOW, BKD_REG_TOP, BKD_REG_BOT, Y_CENTER, INSTRUMENT, FILTER, SUBARRAY, FLOAT_TYPE
 from scipy.stats import median_abs_deviation
 from wave_sol import get_wavelengths
+from lazy_fits import read_block, read_bkd, get_section
+from _cupy_numpy import cpu
 
 def horne_iteration(image, bkd, spectrum, M, V, badpix, read_noise, n_groups_used, smoothed_profile, sigma=5):
     #N is the number of groups used, minus one
@@ -31,8 +33,8 @@ def horne_iteration(image, bkd, spectrum, M, V, badpix, read_noise, n_groups_use
     M = np.array(z_scores**2 < sigma**2, dtype=bool)
     V[~M] = HIGH_ERROR**2
     original_spectrum = np.copy(spectrum)
-    spectrum = np.sum(smoothed_profile * image / V, axis=0) / np.sum(smoothed_profile**2 / V, axis=0)
-    spectrum_variance = np.sum(smoothed_profile, axis=0) / np.sum(smoothed_profile**2 / V, axis=0)
+    spectrum = np.sum(smoothed_profile * image / V, axis=0, dtype=np.float64) / np.sum(smoothed_profile**2 / V, axis=0, dtype=np.float64)
+    spectrum_variance = np.sum(smoothed_profile, axis=0, dtype=np.float64) / np.sum(smoothed_profile**2 / V, axis=0, dtype=np.float64)
 
     #plt.imshow(z_scores, vmin=-5, vmax=5, aspect='auto')
     #plt.show()
@@ -47,10 +49,10 @@ def optimal_extract(image, bkd, badpix, read_noise, n_groups_used, P, max_iter=1
         badpix = np.zeros(image.shape, dtype=bool)
     print("Num badpix", np.sum(badpix))
         
-    spectrum = np.sum(image, axis=0)
+    spectrum = np.sum(image, axis=0, dtype=np.float64)
     simple_spectrum = np.copy(spectrum)
     
-    V = np.ones(image.shape)
+    V = np.ones(image.shape, dtype=image.dtype)
     M = np.ones(image.shape, dtype=bool)
     counter = 0
     
@@ -67,8 +69,8 @@ def optimal_extract(image, bkd, badpix, read_noise, n_groups_used, P, max_iter=1
     print("Final std of z_scores (should be around 1)", np.std(z_scores[M]))
     return spectrum, spectrum_variance, z_scores, simple_spectrum
 
-def get_profile(filename="median_image.npy"):
-    median_image = np.load(filename)[Y_CENTER - OPT_EXTRACT_WINDOW : Y_CENTER + OPT_EXTRACT_WINDOW + 1, X_MIN : X_MAX]
+def get_profile(median_image):
+    median_image = median_image[Y_CENTER - OPT_EXTRACT_WINDOW : Y_CENTER + OPT_EXTRACT_WINDOW + 1, X_MIN : X_MAX]
     median_spectrum = np.sum(median_image, axis=0)
     P = median_image / median_spectrum       
     P[P < 0] = 0
@@ -89,61 +91,77 @@ def get_positions(filename="positions.txt"):
         y_positions[(filename, integration)] = y
     return y_positions
 
-print("Applying optimal extraction")
-P = get_profile()
-y_positions = get_positions()
-
-for filename in sys.argv[1:]:
-    with fits.open(filename) as hdul:
-        assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
-        wavelengths = get_wavelengths(hdul[0].header["INSTRUME"], hdul[0].header["FILTER"])
-        hdulist = [hdul[0], hdul["INT_TIMES"]]
-
-        for i in range(len(hdul["SCI"].data)):
-            print("Processing integration", i)
-
-            data = hdul["SCI"].data[i,:,X_MIN:X_MAX]
-            err = hdul["ERR"].data[i,:,X_MIN:X_MAX]
-            data[:TOP_MARGIN] = 0
-
-            s = np.s_[Y_CENTER - OPT_EXTRACT_WINDOW : Y_CENTER + OPT_EXTRACT_WINDOW + 1, X_MIN : X_MAX]
-
-            #Shift profile
-            shift = y_positions[(filename, i)]
-            rows = np.arange(P.shape[0])
-            shifted_P = scipy.interpolate.interp1d(rows, P.T, kind="cubic", bounds_error=False, fill_value=(P[0], P[-1]))(rows + shift).T                       
-            
-            spectrum, variance, z_scores, simple_spectrum = optimal_extract(
-                hdul["SCI"].data[i][s],
-                hdul["BKD"].data[i][s],
-                hdul["DQ"].data[i][s] != 0,
-                hdul["RNOISE"].data[s],
-                hdul[0].header["NGROUPS"],
-                shifted_P)
-            bkd = hdul["BKD"].data[i][s].mean(axis=0)
-            hdulist.append(fits.BinTableHDU.from_columns([
-                fits.Column(name="WAVELENGTH", format="D", unit="um", array=wavelengths[X_MIN:X_MAX]),
-                fits.Column(name="FLUX", format="D", unit="Electrons/group", array=spectrum),
-                fits.Column(name="ERROR", format="D", unit="Electrons/group", array=np.sqrt(variance)),
-                fits.Column(name="SIMPLE FLUX", format="D", unit="Electrons/group", array=simple_spectrum),
-                fits.Column(name="BKD", format="D", unit="Electrons/group", array=bkd)
-            ]))
-
-            if i == 20: 
-                z_scores_filename = "zscores_{}_" + filename[:-4] + "png"
-                plt.clf()
-                plt.figure(0, figsize=(18,3))
-                plt.imshow(z_scores, vmin=-5, vmax=5, aspect='auto')
-                plt.savefig(z_scores_filename.format(i))
-                #plt.show()
-
-                spectra_filename = "optspectra_{}_" + filename[:-4] + "png"
-                N = hdul[0].header["NGROUPS"] - 1
-                plt.clf()
-                plt.plot(spectrum * N, label="Spectra")
-                plt.plot(variance * N**2, label="Variance")
-                plt.savefig(spectra_filename.format(i))
-
-
-        output_hdul = fits.HDUList(hdulist)    
-        output_hdul.writeto("optx1d_" + os.path.basename(filename), overwrite=True)
+def read_segment(hdul):
+    #The extraction window of a cleaned file: sci, bkd, badpix and read noise
+    rows = np.s_[Y_CENTER - OPT_EXTRACT_WINDOW : Y_CENTER + OPT_EXTRACT_WINDOW + 1]
+    cols = np.s_[X_MIN : X_MAX]
+    sci = cpu(read_block(hdul["SCI"], rows=rows, cols=cols))
+    sci[:, :max(0, TOP_MARGIN - rows.start)] = 0
+    bkd_im = cpu(read_bkd(hdul, rows=rows, cols=cols)[0])
+    badpix = cpu(read_block(hdul["DQ"], rows=rows, cols=cols, dtype=bool))
+    read_noise = np.asarray(get_section(hdul["RNOISE"])[rows, cols], dtype=FLOAT_TYPE)
+    return sci, bkd_im, badpix, read_noise
+
+def extract_segment(sci, bkd_im, badpix, read_noise, n_groups_used, P, shifts, filename):
+    #Optimal extraction of every integration of the window read by
+    #read_segment, with the profile shifted by shifts (one per integration).
+    #Returns a table of spectra for each; filename names the plots.
+    tables = []
+    for i in range(len(sci)):
+        print("Processing integration", i)
+
+        #Shift profile
+        shift = shifts[i]
+        rows = np.arange(P.shape[0])
+        shifted_P = scipy.interpolate.interp1d(rows, P.T, kind="cubic", bounds_error=False, fill_value=(P[0], P[-1]))(rows + shift).T                       
+        
+        spectrum, variance, z_scores, simple_spectrum = optimal_extract(
+            sci[i], bkd_im[i], badpix[i], read_noise,
+            n_groups_used,
+            shifted_P)
+        bkd = bkd_im[i].mean(axis=0)
+        tables.append({"FLUX": spectrum, "ERROR": np.sqrt(variance), "SIMPLE FLUX": simple_spectrum, "BKD": bkd})
+
+        if i == 20: 
+            z_scores_filename = "zscores_{}_" + filename[:-4] + "png"
+            plt.clf()
+            plt.figure(0, figsize=(18,3))
+            plt.imshow(z_scores, vmin=-5, vmax=5, aspect='auto')
+            plt.savefig(z_scores_filename.format(i))
+            #plt.show()
+
+            spectra_filename = "optspectra_{}_" + filename[:-4] + "png"
+            N = n_groups_used - 1
+            plt.clf()
+            plt.plot(spectrum * N, label="Spectra")
+            plt.plot(variance * N**2, label="Variance")
+            plt.savefig(spectra_filename.format(i))
+    return tables
+
+def make_x1d_hdul(primary_hdu, int_times_hdu, wavelengths, tables):
+    #One table HDU per integration, of the columns returned by extract_segment
+    hdulist = [primary_hdu, int_times_hdu]
+    for table in tables:
+        hdulist.append(fits.BinTableHDU.from_columns(
+            [fits.Column(name="WAVELENGTH", format="D", unit="um", array=wavelengths[X_MIN:X_MAX])] +
+            [fits.Column(name=name, format="D", unit="Electrons/group", array=column) for name, column in table.items()]))
+    return fits.HDUList(hdulist)
+
+def get_x1d_filename(filename):
+    return "optx1d_" + os.path.basename(filename)
+
+if __name__ == "__main__":
+    print("Applying optimal extraction")
+    P = get_profile(np.load("median_image.npy"))
+    y_positions = get_positions()
+
+    for filename in sys.argv[1:]:
+        with fits.open(filename) as hdul:
+            assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
+            wavelengths = get_wavelengths(hdul[0].header["INSTRUME"], hdul[0].header["FILTER"])
+
+            #Only the extraction window is read from disk
+            sci, bkd_im, badpix, read_noise = read_segment(hdul)
+            shifts = [y_positions[(filename, i)] for i in range(len(sci))]
+            tables = extract_segment(sci, bkd_im, badpix, read_noise, hdul[0].header["NGROUPS"], P, shifts, filename)
+            make_x1d_hdul(hdul[0], hdul["INT_TIMES"], wavelengths, tables).writeto(get_x1d_filename(filename), overwrite=True)
@@ -0,0 +1,47 @@
+import os
+import hashlib
+import numpy
+from _cupy_numpy import cpu
+from constants import REF_DIR, INSTRUMENT, SUBARRAY, ROTATE, TOP, BOT, LEFT, RIGHT
+
+CACHE_DIR = os.path.join(REF_DIR, "cache")
+
+def get_cache_key(ref_file, name, params=()):
+    #A stale cache is never used: the modification time and size of the
+    #reference file are part of the key, as is everything that determines
+    #how it's cropped and rotated
+    stat = os.stat(ref_file)
+    key = repr((os.path.abspath(ref_file), stat.st_mtime_ns, stat.st_size,
+                INSTRUMENT, SUBARRAY, ROTATE, TOP, BOT, LEFT, RIGHT,
+                name, tuple(params)))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def load_cached(ref_file, name, build, params=()):
+    #Returns the tuple of arrays build() returns, memory-mapped read-only
+    #from .npy files in CACHE_DIR.  build() is only called if the cache
+    #doesn't exist or the reference file has changed.
+    stem = os.path.join(CACHE_DIR, "{}_{}_{}".format(
+        os.path.basename(ref_file).replace(".fits", ""), name,
+        get_cache_key(ref_file, name, params)))
+    index_filename = stem + ".txt"
+
+    if not os.path.exists(index_filename):
+        print("Caching", name, "from", ref_file)
+        arrays = build()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        #Write to temporary names and rename, so that several processes
+        #building the same cache at once never see a partial file
+        for i, arr in enumerate(arrays):
+            tmp_filename = "{}_{}.{}.tmp.npy".format(stem, i, os.getpid())
+            numpy.save(tmp_filename, numpy.ascontiguousarray(cpu(arr)))
+            os.replace(tmp_filename, "{}_{}.npy".format(stem, i))
+        tmp_filename = "{}.{}.tmp".format(index_filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            f.write("{}\n".format(len(arrays)))
+        os.replace(tmp_filename, index_filename)
+
+    with open(index_filename) as f:
+        num_arrays = int(f.read())
+    return tuple(numpy.load("{}_{}.npy".format(stem, i), mmap_mode="r") for i in range(num_arrays))
@@ -1,90 +1,197 @@
 import numpy as np
+import astropy.io.fits
 import astropy.stats
+import os
 import sys
 import pdb
-from astropy.io.fits import ImageHDU
+import argparse
+from multiprocessing import Pool
 from constants import *
+from lazy_fits import read_block, create_image_file, write_image_block, make_image_hdu, OUTPUT_FLOAT_TYPE
+from fitting import interp_masked
 
-def remove_bkd_nircam(data, err, dq):
+#Approximate size of one full-size array of the block of integrations
+#cleaned at once, unless --block-size is given
+BLOCK_BYTES = 2**26
+
+def get_bkd_rows(data):
+    #Background rows of every integration, N_int x N_bkd_rows x N_col
+    return np.concatenate((data[:,BKD_REG_TOP[0]:BKD_REG_TOP[1]],
+                           data[:,BKD_REG_BOT[0]:BKD_REG_BOT[1]]),
+                          axis=1)
+
+
+def fast_nanmedian(data, axis):
+    #Same as np.nanmedian, but when there are no NaNs (the usual case), takes
+    #a plain median of a contiguous copy, partitioned in place, which is
+    #several times faster
+    data = np.moveaxis(data, axis, -1)
+    if np.isnan(data).any():
+        return np.nanmedian(data, axis=-1)
+    return np.median(np.array(data, order="C"), axis=-1, overwrite_input=True)
+
+
+def remove_bkd_nircam(data, err, dq, block_bytes=2**27):
     data = np.copy(data)
     err = np.copy(err)
     dq = np.copy(dq)
     
-    #Modifies data and err (outlier rejection) before estimating bkd
-    for i in range(len(data)):
-        #Fix outliers
-        mask = np.logical_or(np.isnan(data[i]), dq[i] > 0)
-        dq[i] |= mask
-
-        xs = np.arange(data[i].shape[1])
-        for y in range(N_REF, data[i].shape[0]):
-            if np.sum(~mask[y]) == 0:
-                pdb.set_trace()
-            data[i,y] = np.interp(xs, xs[~mask[y]], data[i,y][~mask[y]])
-            err[i,y] = np.interp(xs, xs[~mask[y]], err[i,y][~mask[y]])
+    #Modifies data and err (outlier rejection) before estimating bkd.  Bad
+    #pixels are interpolated over along each row, for a block of
+    #integrations at a time.  Rows with no good pixels are left as NaN, which
+    #the background medians ignore, with HIGH_ERROR errors.
+    mask = np.logical_or(np.isnan(data), dq > 0)
+    dq |= mask
+    block_size = max(1, int(block_bytes // (data[0].size * 8)))
+    for i in range(0, len(data), block_size):
+        rows = np.s_[i : i + block_size, N_REF:]
+        data[rows] = interp_masked(data[rows], mask[rows])
+        err[rows] = interp_masked(err[rows], mask[rows], HIGH_ERROR)
 
+    #1/f noise of each row, then background of each column
     data[:,:N_REF] = 0
-    subtracted = np.zeros(data.shape)
-    var_subtracted = np.zeros(data.shape)
-    subtracted[:,:,:] = np.nanmedian(data[:,:,ONE_OVER_F_WINDOW_LEFT:ONE_OVER_F_WINDOW_RIGHT], axis=2)[:,:,np.newaxis]
-    var_subtracted[:,:,:] = np.sum(err[:,:,ONE_OVER_F_WINDOW_LEFT:ONE_OVER_F_WINDOW_RIGHT]**2, axis=2)[:,:,np.newaxis] / (ONE_OVER_F_WINDOW_RIGHT - ONE_OVER_F_WINDOW_LEFT)**2 * np.pi / 2
-    
-    data_no_bkd = data - subtracted
+    row_bkd = fast_nanmedian(data[:,:,ONE_OVER_F_WINDOW_LEFT:ONE_OVER_F_WINDOW_RIGHT], axis=2)
+    row_var = np.sum(err[:,:,ONE_OVER_F_WINDOW_LEFT:ONE_OVER_F_WINDOW_RIGHT]**2, axis=2, dtype=np.float64) / (ONE_OVER_F_WINDOW_RIGHT - ONE_OVER_F_WINDOW_LEFT)**2 * np.pi / 2
+    data_no_bkd = data - row_bkd.astype(data.dtype)[:,:,np.newaxis]
 
-    bkd_rows = np.concatenate((data[:,BKD_REG_TOP[0]:BKD_REG_TOP[1]],
-                               data[:,BKD_REG_BOT[0]:BKD_REG_BOT[1]]),
-                              axis=1)
     num_bkd_cols = np.diff(BKD_REG_TOP) + np.diff(BKD_REG_BOT)
-    bkd = np.nanmedian(bkd_rows, axis=1)
-    bkd_var = np.sum(np.concatenate((err[:,BKD_REG_TOP[0]:BKD_REG_TOP[1]],
-                                     err[:,BKD_REG_BOT[0]:BKD_REG_BOT[1]]),
-                                    axis=1)**2,
-                     axis=1) / num_bkd_cols**2 * np.pi / 2
-    
-    subtracted += bkd[:,np.newaxis,:]
-    var_subtracted += bkd_var[:,np.newaxis,:]
+    bkd = fast_nanmedian(get_bkd_rows(data), axis=1)
+    bkd_var = np.sum(get_bkd_rows(err)**2, axis=1, dtype=np.float64) / num_bkd_cols**2 * np.pi / 2
     data_no_bkd -= bkd[:,np.newaxis,:]
-    return data_no_bkd, err, subtracted, np.sqrt(var_subtracted), dq
+    return data_no_bkd, err, (bkd, bkd_var, row_bkd, row_var), dq
 
 
 def remove_bkd(data, err, dq):
-    bkd_im = np.zeros(data.shape)
-    bkd_var_im = np.zeros(err.shape)
-        
-    for i in range(data.shape[0]):
-        bkd_rows = np.vstack([
-            data[i,BKD_REG_TOP[0]:BKD_REG_TOP[1]],
-            data[i,BKD_REG_BOT[0]:BKD_REG_BOT[1]]])
-
-        bkd_rows = astropy.stats.sigma_clip(bkd_rows, axis=0)
-        bkd_err_rows = np.vstack([
-            err[i,BKD_REG_TOP[0]:BKD_REG_TOP[1]],
-            err[i,BKD_REG_BOT[0]:BKD_REG_BOT[1]]])
-
-        bkd = np.ma.mean(bkd_rows, axis=0)
-        bkd_var = np.sum(bkd_err_rows**2, axis=0) / bkd_err_rows.shape[1]**2
-
-        bkd_im[i] = bkd
-        bkd_var_im[i] = bkd_var
-        
-    return data - bkd_im, err, bkd_im, np.sqrt(bkd_var_im), dq
-
-for filename in sys.argv[1:]:
+    #Every column of every integration is clipped independently, but all in
+    #one call
+    bkd_rows = astropy.stats.sigma_clip(get_bkd_rows(data), axis=1)
+    bkd_err_rows = get_bkd_rows(err)
+    bkd = np.ma.getdata(np.ma.mean(bkd_rows, axis=1, dtype=np.float64))
+    bkd_var = np.sum(bkd_err_rows**2, axis=1, dtype=np.float64) / bkd_err_rows.shape[2]**2
+    return data - bkd.astype(data.dtype)[:,np.newaxis], err, (bkd, bkd_var, None, None), dq
+
+
+def get_bkd_images(model, shape, dtype):
+    #The background model returned by remove_bkd or remove_bkd_nircam, and
+    #its error, as full images.  model: the background and variance of each
+    #column (N_int x N_col) and, for NIRCAM, of each row (N_int x N_row).
+    bkd, bkd_var, row_bkd, row_var = model
+    bkd_im = np.empty(shape, dtype=dtype)
+    bkd_var_im = np.empty(shape, dtype=dtype)
+    if row_bkd is None:
+        bkd_im[:] = bkd[:,np.newaxis]
+        bkd_var_im[:] = bkd_var[:,np.newaxis]
+    else:
+        bkd_im[:] = row_bkd[:,:,np.newaxis]
+        bkd_var_im[:] = row_var[:,:,np.newaxis]
+        bkd_im += bkd[:,np.newaxis]
+        bkd_var_im += bkd_var[:,np.newaxis]
+    return bkd_im, np.sqrt(bkd_var_im)
+
+
+def clean_block(data, err, dq):
+    #Removes the background of a block of integrations.  Returns the
+    #cleaned data, err and dq, and the background model.
+    if INSTRUMENT == "NIRCAM":
+        return remove_bkd_nircam(data, err, dq)
+    return remove_bkd(data, err, dq)
+
+
+def get_cleaned_filename(filename):
+    return "cleaned_{}".format(filename)
+
+
+def create_cleaned_file(output_filename, hdus, shape, dq_type, column_bkd=False):
+    #Writes hdus (those of the rateints file) to output_filename, with SCI,
+    #ERR and DQ replaced by the cleaned images and the background, which are
+    #filled in with write_cleaned_block.  Compressed HDUs can't be written a block at a
+    #time, so in that case they're written to a separate file that
+    #finish_cleaned_file compresses.
+    N_int, N_row, N_col = shape
+    float_type = OUTPUT_FLOAT_TYPE or FLOAT_TYPE
+    images = [("SCI", shape, float_type), ("ERR", shape, float_type), ("DQ", shape, dq_type)]
+    if not column_bkd:
+        images += [("BKD", shape, float_type), ("BKD_ERR", shape, float_type)]
+    else:
+        images += [("BKD", (N_int, N_col), float_type), ("BKD_ERR", (N_int, N_col), float_type)]
+        if INSTRUMENT == "NIRCAM":
+            images += [("BKD_ROWS", (N_int, N_row), float_type), ("BKD_ROWS_ERR", (N_int, N_row), float_type)]
+
+    #SCI, ERR and DQ keep their places, and the background goes at the end
+    streamed_filename = output_filename + ".part" if COMPRESS_OUTPUT else output_filename
+    images = {image[0]: image for image in images}
+    hdus = [images.pop(hdu.name, hdu) for hdu in hdus] + list(images.values())
+    return create_image_file(streamed_filename, hdus)
+
+
+def write_cleaned_block(outputs, start, data_no_bkd, err, model, dq, column_bkd=False):
+    #Writes the results of clean_block for the integrations from start on.
+    #column_bkd must be what was given to create_cleaned_file.
+    write_image_block(outputs["SCI"], start, data_no_bkd)
+    write_image_block(outputs["ERR"], start, err)
+    write_image_block(outputs["DQ"], start, dq)
+    if not column_bkd:
+        bkd_im, bkd_err_im = get_bkd_images(model, data_no_bkd.shape, data_no_bkd.dtype)
+        write_image_block(outputs["BKD"], start, bkd_im)
+        write_image_block(outputs["BKD_ERR"], start, bkd_err_im)
+    else:
+        bkd, bkd_var, row_bkd, row_var = model
+        write_image_block(outputs["BKD"], start, bkd)
+        write_image_block(outputs["BKD_ERR"], start, np.sqrt(bkd_var))
+        if row_bkd is not None:
+            write_image_block(outputs["BKD_ROWS"], start, row_bkd)
+            write_image_block(outputs["BKD_ROWS_ERR"], start, np.sqrt(row_var))
+
+
+def finish_cleaned_file(output_filename, outputs):
+    #outputs: from create_cleaned_file.  The other HDUs are copied as they
+    #are in the rateints file.
+    if not COMPRESS_OUTPUT:
+        return
+    streamed_filename = output_filename + ".part"
+    with astropy.io.fits.open(streamed_filename) as streamed:
+        hdus = [make_image_hdu(hdu.data, hdu.name) if hdu.name in outputs else hdu for hdu in streamed]
+        astropy.io.fits.HDUList(hdus).writeto(output_filename, overwrite=True)
+    os.remove(streamed_filename)
+
+
+def clean_segment(filename, column_bkd=False, block_size=None):
+    #Removes the background of a segment, a block of integrations at a time,
+    #writing each block straight to the cleaned file.  column_bkd: store the
+    #background model as one row per integration (and, for NIRCAM, the 1/f
+    #noise as one column per integration) instead of as full images.
     print(filename)
-    hdul = astropy.io.fits.open(filename)
-    assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
-    if hdul[0].header["INSTRUME"] == "NIRCAM":
-        data_no_bkd, err, bkd, err_bkd, dq = remove_bkd_nircam(
-            hdul["SCI"].data, hdul["ERR"].data, hdul["DQ"].data)
+    output_filename = get_cleaned_filename(filename)
+    with astropy.io.fits.open(filename) as hdul:
+        assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
+        shape = hdul["SCI"].shape
+        N_int, N_row, N_col = shape
+        if block_size is None:
+            block_size = max(1, int(BLOCK_BYTES // (N_row * N_col * 8)))
+        dq_type = hdul["DQ"].section[0:1].dtype
+        outputs = create_cleaned_file(output_filename, hdul, shape, dq_type, column_bkd)
+
+        for start in range(0, N_int, block_size):
+            ints = np.s_[start : start + block_size]
+            print("Cleaning integrations {} to {}".format(start, min(start + block_size, N_int)))
+            data = read_block(hdul["SCI"], ints)
+            err = read_block(hdul["ERR"], ints)
+            dq = read_block(hdul["DQ"], ints, dtype=dq_type)
+            write_cleaned_block(outputs, start, *clean_block(data, err, dq), column_bkd)
+
+    finish_cleaned_file(output_filename, outputs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filenames", nargs="+")
+    parser.add_argument("--workers", type=int, default=1, help="Number of segments to clean in parallel")
+    parser.add_argument("--block-size", type=int, default=None, help="Number of integrations to clean at once")
+    parser.add_argument("--column-bkd", action="store_true", help="Store BKD and BKD_ERR as one row per integration instead of full images")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            pool.starmap(clean_segment, [(filename, args.column_bkd, args.block_size) for filename in args.filenames])
     else:
-        data_no_bkd, err, bkd, err_bkd, dq = remove_bkd(
-            hdul["SCI"].data, hdul["ERR"].data, hdul["DQ"].data)
-        
-    hdul["SCI"].data = data_no_bkd
-    hdul["ERR"].data = err
-    hdul["DQ"].data = dq
-    hdul.append(ImageHDU(bkd, name="BKD"))
-    hdul.append(ImageHDU(err_bkd, name="BKD_ERR"))
-    hdul.writeto("cleaned_{}".format(filename), overwrite=True)
-    hdul.close()
-    
+        for filename in args.filenames:
+            clean_segment(filename, args.column_bkd, args.block_size)
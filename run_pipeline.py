@@ -0,0 +1,194 @@
+import argparse
+import pickle
+import numpy
+import astropy.io.fits
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import _cupy_numpy as np
+import calibrate
+import remove_bkd
+import get_positions_and_median_image
+import optimal_extract
+import simple_extract
+from get_med_residuals import update_mean, update_median, get_result
+from gather_and_filter import gather
+from lazy_fits import read_block, OUTPUT_FLOAT_TYPE
+from wave_sol import get_wavelengths
+from constants import INSTRUMENT, FILTER, SUBARRAY
+
+#Runs steps 4 to 10 of the README on the uncal files in one go: every
+#segment is calibrated, cleaned and cut down to its extraction window in
+#memory, and only the spectra (optx1d_* or x1d_*) and data.pkl are written.
+#The products are rounded to the precision they'd be written in, so the
+#results are the same as running the scripts one after another.
+#--checkpoints also writes the products of the separate scripts, under the
+#same names, so that any step can be rerun from them.
+
+def as_written(arr):
+    #arr as it would be read back from a product
+    arr = np.cpu(arr)
+    if OUTPUT_FLOAT_TYPE is None or arr.dtype.kind != "f":
+        return arr
+    return numpy.asarray(arr, dtype=OUTPUT_FLOAT_TYPE)
+
+
+def open_segment(filename):
+    hdul = astropy.io.fits.open(filename)
+    assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
+    return hdul
+
+
+def get_residuals1(filename):
+    #Step 4, as far as get_med_residuals.py needs it
+    print("Getting residuals of", filename)
+    with open_segment(filename) as hdul:
+        _, residuals1, _ = calibrate.get_calibrated_ramps(hdul)
+        return as_written(residuals1)
+
+
+def process_segment(filename, median_residuals, grps_to_sat, simple, checkpoints, column_bkd):
+    #Steps 6 to 8 of a segment, up to the positions.  Returns the cleaned
+    #SCI (with outliers fixed) and ERR for get_positions, and the extraction
+    #window of the cleaned segment.
+    print("Processing", filename)
+    with open_segment(filename) as hdul:
+        rateints = calibrate.calibrate_segment(hdul, median_residuals, grps_to_sat)
+        rateints_filename = calibrate.get_rateints_filename(filename)
+        cleaned_filename = remove_bkd.get_cleaned_filename(rateints_filename)
+        hdus = None
+        if checkpoints:
+            hdus = calibrate.get_rateints_hdus(hdul, *rateints)
+            astropy.io.fits.HDUList(hdus).writeto(rateints_filename, overwrite=True)
+
+        sci, err, dq, read_noise, _, _ = rateints
+        rateints = None
+        data = read_block(as_written(sci))
+        err = read_block(as_written(err))
+        dq = np.cpu(dq)
+        print("Cleaning", rateints_filename)
+        data_no_bkd, err, model, dq = remove_bkd.clean_block(data, err, dq)
+        data = sci = None
+        if checkpoints:
+            outputs = remove_bkd.create_cleaned_file(cleaned_filename, hdus, data_no_bkd.shape, dq.dtype, column_bkd)
+            remove_bkd.write_cleaned_block(outputs, 0, data_no_bkd, err, model, dq, column_bkd)
+            remove_bkd.finish_cleaned_file(cleaned_filename, outputs)
+            hdus = None
+
+        bkd_im, bkd_err = remove_bkd.get_bkd_images(model, data_no_bkd.shape, data_no_bkd.dtype)
+        cleaned = {"SCI": as_written(data_no_bkd), "ERR": as_written(err), "DQ": np.cpu(dq),
+                   "BKD": as_written(bkd_im), "BKD_ERR": as_written(bkd_err), "RNOISE": as_written(read_noise)}
+        data_no_bkd = err = bkd_im = bkd_err = None
+        if simple:
+            window = simple_extract.read_segment(cleaned)
+        else:
+            window = optimal_extract.read_segment(cleaned)
+
+        get_positions_and_median_image.fix_segment(cleaned["SCI"], cleaned["DQ"])
+        return {"filename": cleaned_filename, "header": hdul[0].header, "int_times": (numpy.array(hdul["INT_TIMES"].data), hdul["INT_TIMES"].header),
+                "window": window, "sci": cleaned["SCI"], "err": cleaned["ERR"]}
+
+
+def extract_segment(segment, P, shifts, simple):
+    #Step 9 of a segment.  Returns its spectra, which are written as well.
+    print("Extracting", segment["filename"])
+    header = segment["header"]
+    if simple:
+        tables = simple_extract.extract_segment(*segment["window"], header["NGROUPS"], segment["filename"])
+        x1d_filename = simple_extract.get_x1d_filename(segment["filename"])
+    else:
+        tables = optimal_extract.extract_segment(*segment["window"], header["NGROUPS"], P, shifts, segment["filename"])
+        x1d_filename = optimal_extract.get_x1d_filename(segment["filename"])
+    wavelengths = get_wavelengths(header["INSTRUME"], header["FILTER"])
+    hdul = optimal_extract.make_x1d_hdul(astropy.io.fits.PrimaryHDU(header=header), astropy.io.fits.BinTableHDU(*segment["int_times"]), wavelengths, tables)
+    hdul.writeto(x1d_filename, overwrite=True)
+    return hdul[2].data["WAVELENGTH"], tables
+
+
+def combine_residuals(pool, filenames, statistic):
+    #Step 5
+    update = update_median if statistic == "median" else update_mean
+    state = None
+    for residuals1 in pool.map(get_residuals1, filenames):
+        state = update(state, residuals1)
+    return get_result(statistic, state)
+
+
+def get_pool(filenames, workers):
+    #The reference arrays are loaded once and shared with the workers, as
+    #in calibrate.py --workers
+    references = {}
+    for filename in filenames:
+        with astropy.io.fits.open(filename) as hdul:
+            key = calibrate.get_references_key(hdul)
+        if key not in references:
+            references[key] = calibrate.get_references(*key)
+    blocks, descriptions = calibrate.share_references(references)
+    return blocks, ProcessPoolExecutor(workers, initializer=calibrate.attach_references, initargs=(descriptions,))
+
+
+def run(filenames, workers, residuals, median_residuals=None, grps_to_sat=None, simple=False, checkpoints=False, column_bkd=False):
+    blocks, pool = get_pool(filenames, workers)
+    try:
+        with pool:
+            if median_residuals is not None:
+                median_residuals = np.load(median_residuals)
+            elif residuals != "segment":
+                print("Combining the residuals of every segment")
+                median_residuals = combine_residuals(pool, filenames, residuals)
+                if checkpoints:
+                    numpy.save("median_residuals.npy", median_residuals)
+            if grps_to_sat is not None:
+                grps_to_sat = np.load(grps_to_sat)
+
+            num = len(filenames)
+            segments = list(pool.map(process_segment, filenames, [median_residuals] * num, [grps_to_sat] * num,
+                                     [simple] * num, [checkpoints] * num, [column_bkd] * num))
+
+            #Step 8: the template and positions need every segment
+            all_data = numpy.concatenate([segment.pop("sci") for segment in segments])
+            all_error = numpy.concatenate([segment.pop("err") for segment in segments])
+            all_filenames = [segment["filename"] for segment in segments for i in range(len(segment["window"][0]))]
+            all_int_nums = [i for segment in segments for i in range(len(segment["window"][0]))]
+            template = get_positions_and_median_image.get_template(all_data)
+            results = get_positions_and_median_image.get_positions(all_data, all_error, template, all_filenames, all_int_nums)
+            all_data = all_error = None
+            if checkpoints:
+                numpy.save("median_image.npy", template)
+                get_positions_and_median_image.write_positions("positions.txt", all_filenames, all_int_nums, results)
+
+            #Step 9, with the shifts optimal_extract.get_positions reads
+            P = optimal_extract.get_profile(template)
+            shifts = numpy.where(numpy.isnan(results[:,0]), 0, results[:,0])
+            edges = numpy.cumsum([0] + [len(segment["window"][0]) for segment in segments])
+            spectra = list(pool.map(extract_segment, segments, [P] * num, [shifts[start:end] for start, end in zip(edges[:-1], edges[1:])], [simple] * num))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    #Step 10
+    data = numpy.array([table["FLUX"] for _, tables in spectra for table in tables], dtype=numpy.float64)
+    errors = numpy.array([table["ERROR"] for _, tables in spectra for table in tables], dtype=numpy.float64)
+    bkd = numpy.array([table["BKD"] for _, tables in spectra for table in tables], dtype=numpy.float64)
+    times = numpy.concatenate([segment["int_times"][0]["int_mid_BJD_TDB"] for segment in segments])
+    for segment in segments:
+        assert(segment["header"]["INTEND"] - segment["header"]["INTSTART"] + 1 == len(segment["window"][0]))
+    output = gather(data, errors, bkd, times, spectra[-1][0], edges[1:], results[:,0], results[:,1])
+    with open("data.pkl", "wb") as f:
+        pickle.dump(output, f)
+    print("Saved data.pkl")
+    plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filenames", nargs="+", help="uncal files")
+    parser.add_argument("--workers", type=int, default=1, help="Number of segments to process in parallel")
+    parser.add_argument("--residuals", choices=["mean", "median", "segment"], default="mean", help="Subtract the mean or (approximate) median of the RESIDUALS1 of every segment, as get_med_residuals.py does, which calibrates every segment twice; or only the segment's own")
+    parser.add_argument("--median-residuals", help="Subtract these residuals instead, e.g. from an earlier run")
+    parser.add_argument("--grps-to-sat")
+    parser.add_argument("--simple", action="store_true", help="Use simple extraction instead of optimal extraction")
+    parser.add_argument("--checkpoints", action="store_true", help="Also write the rateints and cleaned files, median_residuals.npy, median_image.npy and positions.txt")
+    parser.add_argument("--column-bkd", action="store_true", help="Write the cleaned files as remove_bkd.py --column-bkd does")
+    args = parser.parse_args()
+    run(args.filenames, args.workers, args.residuals, args.median_residuals, args.grps_to_sat, args.simple, args.checkpoints, args.column_bkd)
@@ -14,6 +14,9 @@ from constants import HIGH_ERROR, TOP_MARGIN, X_MIN, X_MAX, SUM_EXTRACT_WINDOW,
 from scipy.stats import median_abs_deviation
 from wave_sol import get_wavelengths
 from fitting import robust_polyfit, fit_gaussian
+from lazy_fits import read_block, read_bkd
+from optimal_extract import make_x1d_hdul
+from _cupy_numpy import cpu
 
 def get_trace(image):
     col_nums = []
@@ -74,50 +77,54 @@ def simple_extract(image, err, window=2):
 
     return spectrum, variance
         
+def read_segment(hdul):
+    #The extraction window of a cleaned file: sci, err, bkd and bkd_err
+    rows = np.s_[Y_CENTER - SUM_EXTRACT_WINDOW : Y_CENTER + SUM_EXTRACT_WINDOW + 1]
+    cols = np.s_[X_MIN:X_MAX]
+    sci = cpu(read_block(hdul["SCI"], rows=rows, cols=cols))
+    sci[:, :max(0, TOP_MARGIN - rows.start)] = 0
+    err = cpu(read_block(hdul["ERR"], rows=rows, cols=cols))
+    bkd_im, bkd_err = [cpu(im) for im in read_bkd(hdul, rows=rows, cols=cols)]
+    return sci, err, bkd_im, bkd_err
+
+def extract_segment(sci, err, bkd_im, bkd_err, n_groups, filename):
+    #Sum extraction of every integration of the window read by
+    #read_segment.  Returns a table of spectra for each; filename names the
+    #plots.
+    tables = []
+    for i in range(len(sci)):
+        print("Processing integration", i)
+
+        spectrum, variance = simple_extract(sci[i], err[i])
+
+        bkd = np.mean(bkd_im[i], axis=0)
+        bkd_var = np.mean(bkd_err[i]**2, axis=0)
+        variance += bkd_var * (2*SUM_EXTRACT_WINDOW + 1)**2
+        tables.append({"FLUX": spectrum, "ERROR": np.sqrt(variance), "BKD": bkd})
+
+        if i == 20:            
+            spectra_filename = "spectra_{}_" + filename[:-4] + "png"
+            N = n_groups - 1 - BAD_GRPS
+            plt.clf()
+            plt.plot(spectrum * N, label="Spectra")
+            plt.plot(variance * N**2, label="Variance")
+            plt.savefig(spectra_filename.format(i))
+    return tables
+
+def get_x1d_filename(filename):
+    return "x1d_" + os.path.basename(filename)
+
 def process_one(filename):
     print("Processing", filename)
     with fits.open(filename) as hdul:
         assert(hdul[0].header["INSTRUME"] == INSTRUMENT and hdul[0].header["FILTER"] == FILTER and hdul[0].header["SUBARRAY"] == SUBARRAY)
         wavelengths = get_wavelengths(hdul[0].header["INSTRUME"], hdul[0].header["FILTER"])
-        hdulist = [hdul[0], hdul["INT_TIMES"]]
-    
-        for i in range(len(hdul["SCI"].data)):
-            print("Processing integration", i)
-            
-            data = hdul["SCI"].data[i,:,X_MIN:X_MAX]
-            err = hdul["ERR"].data[i,:,X_MIN:X_MAX]
-            data[:TOP_MARGIN] = 0
-            
-            s = np.s_[Y_CENTER - SUM_EXTRACT_WINDOW : Y_CENTER + SUM_EXTRACT_WINDOW + 1, X_MIN:X_MAX]
 
-            spectrum, variance = simple_extract(
-                hdul["SCI"].data[i][s],
-                hdul["ERR"].data[i][s]            
-            )
-
-            bkd = np.mean(hdul["BKD"].data[i][s], axis=0)
-            bkd_var = np.mean(hdul["BKD_ERR"].data[i][s]**2, axis=0)
-            variance += bkd_var * (2*SUM_EXTRACT_WINDOW + 1)**2
-        
-            hdulist.append(fits.BinTableHDU.from_columns([
-                fits.Column(name="WAVELENGTH", format="D", unit="um", array=wavelengths[X_MIN:X_MAX]),
-                fits.Column(name="FLUX", format="D", unit="Electrons/group", array=spectrum),
-                fits.Column(name="ERROR", format="D", unit="Electrons/group", array=np.sqrt(variance)),
-                fits.Column(name="BKD", format="D", unit="Electrons/group", array=bkd)
-            ]))
+        #Only the extraction window is read from disk
+        tables = extract_segment(*read_segment(hdul), hdul[0].header["NGROUPS"], filename)
+        make_x1d_hdul(hdul[0], hdul["INT_TIMES"], wavelengths, tables).writeto(get_x1d_filename(filename), overwrite=True)
 
-            if i == 20:            
-                spectra_filename = "spectra_{}_" + filename[:-4] + "png"
-                N = hdul[0].header["NGROUPS"] - 1 - BAD_GRPS
-                plt.clf()
-                plt.plot(spectrum * N, label="Spectra")
-                plt.plot(variance * N**2, label="Variance")
-                plt.savefig(spectra_filename.format(i))
-    
-        output_hdul = fits.HDUList(hdulist)
-        output_hdul.writeto("x1d_" + os.path.basename(filename), overwrite=True)
-    
-filenames = sys.argv[1:]
-with Pool() as pool:
-    pool.map(process_one, filenames)
-    
+if __name__ == "__main__":
+    filenames = sys.argv[1:]
+    with Pool() as pool:
+        pool.map(process_one, filenames)